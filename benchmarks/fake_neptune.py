@@ -0,0 +1,385 @@
+import contextlib
+import math
+import os
+import re
+import threading
+import time
+import zipfile
+import zlib
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from types import SimpleNamespace
+from unittest import mock
+import numpy as np
+import pandas as pd
+from neptune.attributes import Boolean, Datetime, File, FileSeries, FileSet, Float, FloatSeries, Integer, RunState, \
+    String, StringSeries, StringSet
+
+SERIES_POINT_SIZE = 64  # approximate bytes per series point on the wire (json encoded step, value and timestamp)
+SERIES_PAGE_SIZE = 10000  # points per request of neptune's fetch_values
+UPLOAD_BATCH_SIZE = 1000  # operations sent per request by neptune's async upload queue
+START_TIME = datetime(2024, 1, 1)
+
+
+class ProjectShape:
+    # Size of the simulated project: number of runs and, per run, number of attributes of every type
+    def __init__(self, runs=20, atoms=20, float_series=5, string_series=1, series_length=1000, files=1,
+                 file_size=1024 ** 2, file_set_files=0, file_series_files=0, tags=2):
+        self.runs = runs
+        self.atoms = atoms
+        self.float_series = float_series
+        self.string_series = string_series
+        self.series_length = series_length
+        self.files = files
+        self.file_size = file_size
+        self.file_set_files = file_set_files
+        self.file_series_files = file_series_files
+        self.tags = tags
+
+
+class FakeBackend:
+    # Local stand-in for the neptune client and server. Every request sleeps for the configured latency plus the time
+    # its payload takes at the configured bandwidth (bytes/s, None for unlimited), so throughput depends on concurrency
+    # like it does against the real backend. Data is generated deterministically from run ids and attribute paths.
+    def __init__(self, shape: ProjectShape, latency=0.05, bandwidth=None):
+        self.shape = shape
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes_downloaded = 0
+        self.bytes_uploaded = 0
+        self.run_ids = [f'BENCH-{number}' for number in range(1, shape.runs + 1)]
+        self.versions = {}  # {run id: number of modifications}, see modify_run
+        self.created_ids = []  # ids of the runs and projects created by uploads
+        self.trashed_ids = []
+
+    def request(self, size=0, upload=False, requests=1):
+        with self.lock:
+            self.requests += requests
+            if upload:
+                self.bytes_uploaded += size
+            else:
+                self.bytes_downloaded += size
+        delay = self.latency * requests + (size / self.bandwidth if self.bandwidth else 0)
+        if delay > 0:
+            time.sleep(delay)
+
+    @contextlib.contextmanager
+    def patch(self):
+        # replaces the entry points of the neptune client used by the archiver, retriever and verifier
+        with mock.patch('neptune.init_project', self.init_project), mock.patch('neptune.init_run', self.init_run), \
+                mock.patch('neptune.management.create_project', self.create_project), \
+                mock.patch('neptune.management.trash_objects', self.trash_objects):
+            yield self
+
+    def init_project(self, project=None, mode='async', **kwargs):
+        self.request()
+        if mode == 'read-only':
+            return FakeReadContainer(self, self.project_structure())
+        return FakeUploadContainer(self)
+
+    def init_run(self, with_id=None, project=None, mode='async', **kwargs):
+        self.request()
+        if mode == 'read-only':
+            return FakeReadContainer(self, self.run_structure(with_id))
+        return FakeUploadContainer(self)
+
+    def create_project(self, workspace=None, name=None, key=None, visibility=None, **kwargs):
+        self.request()
+
+    def trash_objects(self, project=None, ids=None, **kwargs):
+        self.request()
+        with self.lock:
+            self.trashed_ids.extend([ids] if isinstance(ids, str) else ids)
+
+    def create_id(self):
+        with self.lock:
+            self.created_ids.append(f'RESTORED-{len(self.created_ids) + 1}')
+            return self.created_ids[-1]
+
+    def project_structure(self):
+        return {'sys': {'name': FakeString(self, 'project'), 'id': FakeString(self, 'BENCH'),
+                        'key': FakeString(self, 'BENCH'), 'visibility': FakeString(self, 'priv'),
+                        'creation_time': FakeDatetime(self, START_TIME)},
+                'description': FakeString(self, 'simulated project')}
+
+    def run_structure(self, run_id):
+        shape = self.shape
+        number = self.run_ids.index(run_id)
+        structure = {
+            'sys': {'id': FakeString(self, run_id), 'name': FakeString(self, f'run {number}'),
+                    'creation_time': FakeDatetime(self, self.creation_time(number)),
+                    'modification_time': FakeDatetime(self, self.modification_time(run_id)),
+                    'tags': FakeStringSet(self, self.tags(number)), 'state': FakeRunState()},
+            'params': {name: atom_type(self, value) for name, (atom_type, value) in self.atoms(number).items()},
+            'metrics': {f'metric_{index}': FakeFloatSeries(self, self.series(run_id, f'metrics/metric_{index}'))
+                        for index in range(shape.float_series)},
+            'logs': {f'log_{index}': FakeStringSeries(self, self.series(run_id, f'logs/log_{index}', strings=True))
+                     for index in range(shape.string_series)},
+            'files': {f'file_{index}': FakeFile(self, seeded_bytes(self.seed(run_id, f'files/file_{index}'),
+                                                                   shape.file_size))
+                      for index in range(shape.files)}}
+        if shape.file_set_files:
+            structure['data'] = FakeFileSet(self, {f'part_{index}.bin': seeded_bytes(self.seed(run_id, f'data/{index}'),
+                                                                                     shape.file_size)
+                                                   for index in range(shape.file_set_files)})
+        if shape.file_series_files:
+            structure['images'] = FakeFileSeries(self, [seeded_bytes(self.seed(run_id, f'images/{index}'),
+                                                                     shape.file_size)
+                                                        for index in range(shape.file_series_files)])
+        return structure
+
+    @staticmethod
+    def creation_time(number):
+        return START_TIME + timedelta(minutes=number)
+
+    def modification_time(self, run_id):
+        return self.creation_time(self.run_ids.index(run_id)) + timedelta(hours=1, minutes=self.versions.get(run_id, 0))
+
+    def modify_run(self, run_id):
+        # the run's modification time changes and its series and files get new content, like when it is resumed
+        self.versions[run_id] = self.versions.get(run_id, 0) + 1
+
+    def seed(self, run_id, path):
+        # data of unmodified runs does not depend on the modifications of other runs
+        version = self.versions.get(run_id, 0)
+        return f'{run_id}/{path}' + (f'@{version}' if version else '')
+
+    def tags(self, number):
+        return [f'tag_{(number + index) % 10}' for index in range(self.shape.tags)]
+
+    def atoms(self, number):
+        # {name: (attribute type, value)}, cycling through the atom types
+        atom_types = ((FakeFloat, number * 0.5), (FakeInteger, number), (FakeString, f'value {number}'),
+                      (FakeBoolean, number % 2 == 0))
+        return {f'param_{index}': atom_types[index % len(atom_types)] for index in range(self.shape.atoms)}
+
+    def series(self, run_id, path, strings=False):
+        random = np.random.default_rng(zlib.crc32(self.seed(run_id, path).encode()))
+        steps = np.arange(self.shape.series_length, dtype=float)
+        values = random.random(self.shape.series_length)
+        if strings:
+            values = np.array([f'line {step:.0f}: {value:.6f}' for step, value in zip(steps, values)], dtype=object)
+        timestamps = int(START_TIME.timestamp() * 1000) + np.arange(self.shape.series_length, dtype=np.int64) * 1000
+        return steps, values, timestamps
+
+    def fetch_runs_table(self, query=None, sort_by='sys/creation_time', ascending=False, limit=None, **kwargs):
+        # understands the creation time queries the archiver pages the runs table with, runs are always sorted by
+        # creation time
+        numbers = list(range(len(self.run_ids)))
+        if query is not None:
+            since = pd.Timestamp(re.search(r'"(.+)"', query).group(1)).tz_localize(None)
+            numbers = [number for number in numbers if table_time(self.creation_time(number)) >= since]
+        if not ascending:
+            numbers.reverse()
+        rows = []
+        for number in numbers[:limit]:
+            run_id = self.run_ids[number]
+            row = {'sys/id': run_id, 'sys/name': f'run {number}',
+                   'sys/creation_time': table_time(self.creation_time(number)),
+                   'sys/modification_time': table_time(self.modification_time(run_id)),
+                   'sys/tags': ','.join(self.tags(number))}
+            row.update({f'params/{name}': value for name, (_, value) in self.atoms(number).items()})
+            row.update({f'metrics/metric_{index}': self.series(run_id, f'metrics/metric_{index}')[1][-1]
+                        for index in range(self.shape.float_series) if self.shape.series_length})
+            rows.append(row)
+        runs_table = pd.DataFrame(rows)
+        self.request(runs_table.memory_usage(deep=True).sum())
+        return SimpleNamespace(to_pandas=lambda: runs_table)
+
+
+def table_time(local_time):
+    # like neptune, datetimes of the runs table are naive UTC
+    return pd.Timestamp(local_time.astimezone(timezone.utc)).tz_localize(None)
+
+
+def seeded_bytes(seed, size):
+    return np.random.default_rng(zlib.crc32(seed.encode())).bytes(size)
+
+
+class FakeReadContainer:
+    # read-only run or project
+    def __init__(self, backend, structure):
+        self.backend = backend
+        self.structure = structure
+
+    def get_structure(self):
+        return self.structure
+
+    def fetch_runs_table(self, query=None, sort_by='sys/creation_time', ascending=False, limit=None, **kwargs):
+        return self.backend.fetch_runs_table(query=query, sort_by=sort_by, ascending=ascending, limit=limit, **kwargs)
+
+    def __getitem__(self, path):
+        value = self.structure
+        for key in path.split('/'):
+            value = value[key]
+        return value
+
+    def stop(self):
+        pass
+
+
+class FakeUploadContainer:
+    # run or project opened for writing, operations are queued and sent in batches when the container is stopped
+    def __init__(self, backend):
+        self.backend = backend
+        self._sys_id = backend.create_id()
+        self.lock = threading.Lock()
+        self.operations = 0
+        self.bytes = 0
+
+    def queue(self, size, operations=1):
+        with self.lock:
+            self.operations += operations
+            self.bytes += size
+
+    def __getitem__(self, path):
+        return FakeUploadHandler(self)
+
+    def __setitem__(self, path, value):
+        self.queue(len(str(value)))
+
+    def stop(self):
+        if self.operations:
+            self.backend.request(self.bytes, upload=True, requests=math.ceil(self.operations / UPLOAD_BATCH_SIZE))
+        self.operations = 0
+        self.bytes = 0
+
+
+class FakeUploadHandler:
+    def __init__(self, container):
+        self.container = container
+
+    def extend(self, values, steps=None, timestamps=None):
+        self.container.queue(len(values) * SERIES_POINT_SIZE, len(values))
+
+    def add(self, values):
+        self.container.queue(sum(len(str(value)) for value in values))
+
+    def upload(self, path):
+        self.container.queue(os.path.getsize(path))
+
+    def upload_files(self, path):
+        self.container.queue(sum(file.stat().st_size for file in Path(path).rglob('*') if file.is_file()))
+
+    def append(self, file):
+        self.container.queue(os.path.getsize(file.path))
+
+
+# The fake attributes subclass neptune's attribute types, such that the archiver dispatches on them like on real ones.
+class FakeAtomMixin:
+    def __init__(self, backend, value):
+        self.backend = backend
+        self.value = value
+
+    def fetch(self):
+        self.backend.request(len(str(self.value)))
+        return self.value
+
+
+class FakeBoolean(FakeAtomMixin, Boolean):
+    pass
+
+
+class FakeFloat(FakeAtomMixin, Float):
+    pass
+
+
+class FakeInteger(FakeAtomMixin, Integer):
+    pass
+
+
+class FakeString(FakeAtomMixin, String):
+    pass
+
+
+class FakeDatetime(FakeAtomMixin, Datetime):
+    pass
+
+
+class FakeStringSet(FakeAtomMixin, StringSet):
+    def fetch(self):
+        self.backend.request(sum(len(value) for value in self.value))
+        return set(self.value)
+
+
+class FakeRunState(RunState):
+    def __init__(self):
+        pass
+
+
+def series_options(series_type):
+    # neptune's series types take their batching options as class arguments, which subclasses have to repeat
+    return {'max_batch_size': series_type.max_batch_size, 'operation_cls': series_type.operation_cls}
+
+
+class FakeSeriesMixin:
+    def __init__(self, backend, series):
+        self.backend = backend
+        self.steps, self.values, self.timestamps = series
+
+    def _fetch_values_from_backend(self, offset, limit):
+        end = min(offset + limit, len(self.steps))
+        self.backend.request(max(end - offset, 0) * SERIES_POINT_SIZE)
+        return SimpleNamespace(values=[SimpleNamespace(step=self.steps[index], value=self.values[index],
+                                                       timestampMillis=int(self.timestamps[index]))
+                                       for index in range(offset, end)],
+                               totalItemCount=len(self.steps))
+
+    def fetch_values(self, include_timestamp=True, progress_bar=None):
+        # like neptune, empty series have no columns and timestamps are naive local datetimes
+        self.backend.request(len(self.steps) * SERIES_POINT_SIZE,
+                             requests=max(math.ceil(len(self.steps) / SERIES_PAGE_SIZE), 1))
+        if len(self.steps) == 0:
+            return pd.DataFrame()
+        timestamps = pd.to_datetime(self.timestamps, unit='ms', utc=True).tz_convert(
+            datetime.now().astimezone().tzinfo).tz_localize(None)
+        return pd.DataFrame({'step': self.steps, 'value': self.values, 'timestamp': timestamps})
+
+
+class FakeFloatSeries(FakeSeriesMixin, FloatSeries, **series_options(FloatSeries)):
+    pass
+
+
+class FakeStringSeries(FakeSeriesMixin, StringSeries, **series_options(StringSeries)):
+    pass
+
+
+class FakeFile(File):
+    def __init__(self, backend, content):
+        self.backend = backend
+        self.content = content
+
+    def download(self, destination=None, progress_bar=None):
+        self.backend.request(len(self.content))
+        Path(destination).write_bytes(self.content)
+
+
+class FakeFileSet(FileSet):
+    def __init__(self, backend, members):
+        self.backend = backend
+        self.members = members
+
+    def download(self, destination=None, progress_bar=None):
+        self.backend.request(sum(len(content) for content in self.members.values()))
+        with zipfile.ZipFile(destination, 'w') as zip_file:
+            for name, content in self.members.items():
+                zip_file.writestr(name, content)
+
+    def list_fileset_files(self, path=None):
+        self.backend.request()
+        return [SimpleNamespace(name=name, size=len(content), mtime=START_TIME, file_type='file')
+                for name, content in self.members.items()]
+
+
+class FakeFileSeries(FileSeries, **series_options(FileSeries)):
+    def __init__(self, backend, contents):
+        self.backend = backend
+        self.contents = contents
+
+    def download(self, destination=None, progress_bar=None):
+        Path(destination).mkdir(parents=True, exist_ok=True)
+        for index, content in enumerate(self.contents):
+            self.backend.request(len(content))
+            (Path(destination) / f'{index}.bin').write_bytes(content)
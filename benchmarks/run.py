@@ -0,0 +1,124 @@
+import argparse
+import json
+import multiprocessing
+import resource
+import shutil
+import tempfile
+import time
+from pathlib import Path
+from benchmarks.fake_neptune import FakeBackend, ProjectShape
+from src.utils import CompressionFormats, ContainerFormats, SeriesFormats
+
+# Offline throughput benchmark of archiving and restoring against a simulated neptune backend, run from the repository
+# root with `python -m benchmarks.run`. Every phase runs in its own process, so the reported peak RSS is per phase.
+
+ARCHIVE_NAME = 'benchmark'
+
+
+def run_archive(backend, destination, args):
+    from src.archiver import Archiver
+    with backend.patch():
+        start = time.perf_counter()
+        archiver = Archiver(destination=destination, archive_name=ARCHIVE_NAME, project_id='bench/project',
+                            num_threads=args.num_threads, series_format=args.series_format,
+                            container=args.container, series_chunk_size=args.series_chunk_size,
+                            compression=args.compression)
+        failed_runs = archiver.archive(store_runs_table=True)
+        duration = time.perf_counter() - start
+    return report('archive', backend, duration, backend.bytes_downloaded, failed_runs=len(failed_runs))
+
+
+def run_restore(backend, source, args):
+    from src.retriever import Retriever
+    with backend.patch():
+        start = time.perf_counter()
+        retriever = Retriever(source, 'bench', 'restored', series_chunk_size=args.series_chunk_size)
+        failed_runs = retriever.restore(num_workers=args.num_workers)
+        duration = time.perf_counter() - start
+    return report('restore', backend, duration, backend.bytes_uploaded, failed_runs=len(failed_runs))
+
+
+def report(phase, backend, duration, transferred_bytes, failed_runs):
+    return {'phase': phase, 'runs': backend.shape.runs, 'failed_runs': failed_runs, 'seconds': round(duration, 3),
+            'runs_per_second': round(backend.shape.runs / duration, 3),
+            'megabytes_per_second': round(transferred_bytes / 1024 ** 2 / duration, 3),
+            'requests': backend.requests,
+            'peak_rss_megabytes': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)}
+
+
+def run_phase(phase_function, *args):
+    # forked children inherit the backend without pickling it, only the report is sent back
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=lambda: sender.send(phase_function(*args)))
+    process.start()
+    sender.close()  # the child holds the only sending end, so recv fails instead of blocking if the child dies
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f'{phase_function.__name__} failed with exit code {process.exitcode}')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark archiving and restoring against a simulated neptune '
+                                                 'backend')
+    parser.add_argument('--runs', type=int, default=20, help='number of runs of the simulated project')
+    parser.add_argument('--atoms', type=int, default=20, help='number of atoms per run')
+    parser.add_argument('--float-series', type=int, default=5, help='number of float series per run')
+    parser.add_argument('--string-series', type=int, default=1, help='number of string series per run')
+    parser.add_argument('--series-length', type=int, default=1000, help='number of points per series')
+    parser.add_argument('--files', type=int, default=1, help='number of files per run')
+    parser.add_argument('--file-size', type=int, default=1024 ** 2, help='size of every file in bytes')
+    parser.add_argument('--file-set-files', type=int, default=0, help='number of files in the file set of every run')
+    parser.add_argument('--file-series-files', type=int, default=0,
+                        help='number of files in the file series of every run')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds every request to the backend takes')
+    parser.add_argument('--bandwidth', type=float, default=None,
+                        help='bandwidth of the backend in MB/s per request. If None, it is unlimited')
+    parser.add_argument('--num-threads', type=int, default=10, help='--num-threads of archive')
+    parser.add_argument('--num-workers', type=int, default=1, help='--num-workers of retrieve')
+    parser.add_argument('--series-format', type=str, default=SeriesFormats.CSV,
+                        choices=[SeriesFormats.CSV, SeriesFormats.PARQUET])
+    parser.add_argument('--container', type=str, default=None, choices=[ContainerFormats.ZIP])
+    parser.add_argument('--series-chunk-size', type=int, default=None)
+    parser.add_argument('--compression', type=str, default=None, choices=[CompressionFormats.ZSTD])
+    parser.add_argument('--phases', type=str, nargs='+', default=['archive', 'restore'],
+                        choices=['archive', 'restore'])
+    parser.add_argument('--json', action='store_true', help='print one json object per phase, e.g. to track results')
+    args = parser.parse_args()
+
+    shape = ProjectShape(runs=args.runs, atoms=args.atoms, float_series=args.float_series,
+                         string_series=args.string_series, series_length=args.series_length, files=args.files,
+                         file_size=args.file_size, file_set_files=args.file_set_files,
+                         file_series_files=args.file_series_files)
+    backend = FakeBackend(shape, latency=args.latency,
+                          bandwidth=args.bandwidth * 1024 ** 2 if args.bandwidth else None)
+    work_dir = Path(tempfile.mkdtemp(prefix='neptune-archiver-benchmark-'))
+    archive_path = work_dir / (ARCHIVE_NAME + '.zip' if args.container == ContainerFormats.ZIP else ARCHIVE_NAME)
+    try:
+        results = []
+        archive_result = run_phase(run_archive, backend, work_dir, args)  # restoring needs an archive in any case
+        if 'archive' in args.phases:
+            results.append(archive_result)
+        if 'restore' in args.phases:
+            results.append(run_phase(run_restore, backend, archive_path, args))
+        archive_size = sum(path.stat().st_size for path in archive_path.rglob('*') if path.is_file()) \
+            if archive_path.is_dir() else archive_path.stat().st_size
+    finally:
+        shutil.rmtree(work_dir)
+    for result in results:
+        result['archive_megabytes'] = round(archive_size / 1024 ** 2, 3)
+        if args.json:
+            print(json.dumps(result))
+        else:
+            print(f'{result["phase"]:>8}: {result["runs_per_second"]:10.2f} runs/s '
+                  f'{result["megabytes_per_second"]:10.2f} MB/s {result["peak_rss_megabytes"]:10.1f} MB peak RSS '
+                  f'{result["requests"]:8d} requests {result["seconds"]:8.2f} s {result["failed_runs"]} failed')
+
+
+if __name__ == '__main__':
+    main()
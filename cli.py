@@ -1,25 +1,118 @@
 import argparse
 from src.archiver import Archiver
-from src.retriever import Retriever
+from src.catalog import Catalog
+from src.merger import Merger
+from src.retriever import AttributeFilter, Retriever
+from src.storage import open_archive
+from src.verifier import Verifier
+from datetime import datetime
 from src.utils import *
 from pathlib import Path
 
 
-# TODO: implement option to store and reload form .zip etc. files
 # TODO: exception handling
-# TODO implement verifier
+
+def read_run_ids(run_ids_file):
+    if not run_ids_file:
+        return None
+    with Path(run_ids_file).open('r') as file:
+        return {line.strip() for line in file if line.strip()}
+
+
+def write_failed_runs(failed_runs, failed_runs_file, command, retry_options):
+    print(f'{len(failed_runs)} run(s) could not be {command}.')
+    if failed_runs_file:
+        with Path(failed_runs_file).open('w') as file:
+            file.writelines(run_id + '\n' for run_id in failed_runs)
+        print(f'Failed run ids written to {failed_runs_file}. Retry them with --run-ids-file {failed_runs_file} '
+              f'{retry_options}')
+
 
 def archive(args):
     destination = args.destination
     destination = Path(destination) if destination else Path.cwd()
     archiver = Archiver(destination=destination, project_id=args.project_id, archive_name=args.archive_name,
-                        num_threads=args.num_threads)
-    archiver.archive(store_runs_table=args.store_runs_table)
+                        num_threads=args.num_threads, incremental=args.incremental,
+                        series_format=args.series_format, container=args.container,
+                        series_chunk_size=args.series_chunk_size, metrics_file=args.metrics_file,
+                        progress=args.progress, run_ids=read_run_ids(args.run_ids_file), retries=args.retries,
+                        adaptive_concurrency=(not args.fixed_concurrency), shard=args.shard,
+                        runs_page_size=args.runs_page_size, compression=args.compression,
+                        skip_project=args.skip_project_archiving)
+    failed_runs = archiver.archive(store_runs_table=args.store_runs_table)
+    if failed_runs:
+        # container archives can not be continued, their failed runs are archived separately and merged
+        retry_options = '--incremental' if not args.container else \
+            ('--skip-project-archiving --archive_name <new name>, then combine both archives with merge --sources '
+             f'{archiver.destination} <new archive> --destination <merged archive>')
+        write_failed_runs(failed_runs, args.failed_runs_file, 'archived', retry_options)
 
 
 def retrieve(args):
-    retriever = Retriever(Path(args.source), args.workspace, args.project_name, args.alternative_sys_namespace)
-    retriever.restore((not args.no_project_creation), args.visibility, args.key)
+    skipped_types = [remote_key for remote_key, skip in ((RemoteKeys.FILES, args.skip_files),
+                                                         (RemoteKeys.FILE_SETS, args.skip_file_sets),
+                                                         (RemoteKeys.FILE_SERIES, args.skip_file_series)) if skip]
+    attribute_filter = AttributeFilter(include=args.include, exclude=args.exclude, skipped_types=skipped_types)
+    retriever = Retriever(Path(args.source), args.workspace, args.project_name, args.alternative_sys_namespace,
+                          series_chunk_size=args.series_chunk_size, metrics_file=args.metrics_file,
+                          progress=args.progress, attribute_filter=attribute_filter)
+    run_ids = read_run_ids(args.run_ids_file)
+    if args.run_id:
+        run_ids = (run_ids or set()) | set(args.run_id)
+    if args.tag or args.where:
+        matching_runs = set(retriever.find_runs(args.tag or (), args.where or ()))
+        run_ids = matching_runs if run_ids is None else run_ids & matching_runs
+    failed_runs = retriever.restore((not args.no_project_creation), args.visibility, args.key,
+                                    num_workers=args.num_workers, run_ids=run_ids,
+                                    upload_project=(not args.skip_project_upload))
+    if failed_runs:
+        # partially restored runs were moved to the trash, unless a message above says otherwise
+        write_failed_runs(failed_runs, args.failed_runs_file, 'restored',
+                          '--no-project-creation --skip-project-upload, after deleting partially restored runs that '
+                          'could not be moved to the trash')
+
+
+def merge(args):
+    Merger([Path(source) for source in args.sources], Path(args.destination), num_workers=args.num_workers).merge()
+    print(f'Merged {len(args.sources)} archive(s) into {args.destination}.')
+
+
+def parse_shard(value):
+    # `index/count` with 0 <= index < count
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Shard "{value}" is not of the form index/count, e.g. 0/4.')
+    if not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f'Shard index of "{value}" must be at least 0 and less than {count}.')
+    return index, count
+
+
+def ls(args):
+    catalog = Catalog.open(open_archive(Path(args.source)))
+    for run_id, creation_time, tags in catalog.list_runs():
+        creation_time = datetime.fromtimestamp(creation_time).isoformat() if creation_time is not None else ''
+        print(f'{run_id}\t{creation_time}\t{tags or ""}')
+    catalog.close()
+
+
+def query(args):
+    catalog = Catalog.open(open_archive(Path(args.source)))
+    for run_id in catalog.query(args.tag or (), args.where or ()):
+        print(run_id)
+    catalog.close()
+
+
+def verify(args):
+    verifier = Verifier(Path(args.source), num_workers=args.num_workers)
+    problems = verifier.verify_checksums()
+    if args.project_id:
+        problems.extend(verifier.compare_with_project(args.project_id, args.check_series_lengths))
+    for problem in problems:
+        print(problem)
+    if problems:
+        raise SystemExit(f'Verification found {len(problems)} problem(s).')
+    print('Archive verified.')
 
 
 def main():
@@ -27,6 +120,11 @@ def main():
     subparsers = parser.add_subparsers(dest='command')
     archive_parser = subparsers.add_parser('archive', help='Archive project')
     retrieve_parser = subparsers.add_parser('retrieve', help='Retrieve project from archive and upload it to neptune')
+    ls_parser = subparsers.add_parser('ls', help='List the runs of an archive')
+    query_parser = subparsers.add_parser('query', help='Print the ids of archived runs matching tags and conditions')
+    merge_parser = subparsers.add_parser('merge', help='Combine shard archives into one archive')
+    verify_parser = subparsers.add_parser('verify', help='Check an archive against its checksums and, optionally, '
+                                                         'against the live project')
 
     # archive_parser arguments
     archive_parser.add_argument('--project-id', type=str, help="Name of a project in the form "
@@ -40,11 +138,42 @@ def main():
     archive_parser.add_argument('--store-runs-table', action='store_true',
                                 help='whether to include a copy of the runs_table')
     archive_parser.add_argument('--num-threads', type=int, default=10,
-                                help='number of threads for parallel downloading')
+                                help='number of threads for parallel downloading, which is also the maximum number '
+                                     'of concurrent requests to neptune')
+    archive_parser.add_argument('--retries', type=int, default=3,
+                                help='number of retries of requests that failed transiently, e.g. by throttling, '
+                                     'timeouts or server errors')
+    archive_parser.add_argument('--fixed-concurrency', action='store_true',
+                                help='always make --num-threads concurrent requests instead of lowering the number '
+                                     'while neptune throttles or slows down')
+    archive_parser.add_argument('--incremental', action='store_true',
+                                help='continue an existing archive, only archiving runs that are new or were modified '
+                                     'since they were last archived')
+    archive_parser.add_argument('--series-format', type=str, default=SeriesFormats.CSV,
+                                choices=[SeriesFormats.CSV, SeriesFormats.PARQUET],
+                                help='storage format of float and string series. parquet stores all series of a run in '
+                                     'compressed columnar files and requires pyarrow')
+    archive_parser.add_argument('--container', type=str, default=None, choices=[ContainerFormats.ZIP],
+                                help='write the archive to a single container file instead of a directory')
+    archive_parser.add_argument('--compression', type=str, default=None, choices=[CompressionFormats.ZSTD],
+                                help='store run and project structures, csv series and the log zstd compressed. '
+                                     'retrieve decompresses them transparently. Requires zstandard')
+    archive_parser.add_argument('--series-chunk-size', type=int, default=None,
+                                help='fetch and write series in chunks of this many points to bound memory usage. If '
+                                     'None, every series is fetched at once')
+    archive_parser.add_argument('--skip-project-archiving', action='store_true',
+                                help='only archive runs, e.g. when retrying the failed runs of a container archive')
+    archive_parser.add_argument('--runs-page-size', type=int, default=1000,
+                                help='number of runs per request when fetching the runs table. Runs are archived while '
+                                     'further pages are fetched')
+    archive_parser.add_argument('--shard', type=parse_shard, default=None,
+                                help='only archive the runs of shard index/count, e.g. 0/4, to an archive named '
+                                     '<archive_name>-shard-<index>-of-<count>. Only shard 0 archives the project. '
+                                     'Combine the shard archives with merge')
 
     # retrieve_parser arguments
     retrieve_parser.add_argument('--source', type=str,
-                                 help='path to neptune archive')
+                                 help='path to neptune archive, either a directory or a .zip container')
     retrieve_parser.add_argument('--alternative-sys-namespace', type=str, default=None,
                                  help='Namespace for read-only attributes of the archived project. If None, read-only '
                                       'attributes are not uploaded. Applies to both project and run data.')
@@ -62,6 +191,70 @@ def main():
 
     retrieve_parser.add_argument('--visibility', type=str, default=None,
                                  help=f'Visibility. If None, uses sys/visibility from {PROJECT_STRUCTURE}.')
+    retrieve_parser.add_argument('--num-workers', type=int, default=1,
+                                 help='number of runs restored concurrently, which is also the maximum number of open '
+                                      'neptune runs and local upload queues')
+    retrieve_parser.add_argument('--skip-project-upload', action='store_true',
+                                 help='do not upload the archived project data, only runs')
+    retrieve_parser.add_argument('--series-chunk-size', type=int, default=None,
+                                 help='read and upload series in chunks of this many points to bound memory usage. If '
+                                      'None, every series is uploaded at once')
+    retrieve_parser.add_argument('--tag', type=str, action='append',
+                                 help='only restore runs with this tag, can be repeated. Requires the archive catalog')
+    retrieve_parser.add_argument('--where', type=str, action='append',
+                                 help='only restore runs fulfilling a condition such as "val/acc > 0.9", can be '
+                                      'repeated. Requires the archive catalog')
+    retrieve_parser.add_argument('--run-id', type=str, action='append',
+                                 help='only restore this run, can be repeated and combined with --run-ids-file')
+    retrieve_parser.add_argument('--include', type=str, action='append',
+                                 help='only restore attributes whose path matches this glob, e.g. "metrics/*", can be '
+                                      'repeated. Applies to runs and project, sys/tags and other sys attributes are '
+                                      'only restored if they match')
+    retrieve_parser.add_argument('--exclude', type=str, action='append',
+                                 help='do not restore attributes whose path matches this glob, e.g. "artifacts/*", can '
+                                      'be repeated')
+    retrieve_parser.add_argument('--skip-files', action='store_true', help='do not restore files')
+    retrieve_parser.add_argument('--skip-file-sets', action='store_true', help='do not restore file sets')
+    retrieve_parser.add_argument('--skip-file-series', action='store_true', help='do not restore file series')
+
+    # arguments of archive_parser and retrieve_parser
+    for transfer_parser in (archive_parser, retrieve_parser):
+        transfer_parser.add_argument('--metrics-file', type=str, default=None,
+                                     help='append timings, bytes and queue depth per run and attribute type to this '
+                                          'JSON-lines file')
+        transfer_parser.add_argument('--progress', action='store_true',
+                                     help='print runs done, throughput and ETA to stderr')
+        transfer_parser.add_argument('--run-ids-file', type=str, default=None,
+                                     help='file with one run id per line. If given, only these runs are archived or '
+                                          'restored.')
+        transfer_parser.add_argument('--failed-runs-file', type=str, default=None,
+                                     help='file to write the ids of runs that could not be archived or restored to')
+
+    # ls_parser and query_parser arguments
+    for catalog_parser in (ls_parser, query_parser):
+        catalog_parser.add_argument('--source', type=str, help='path to neptune archive')
+    query_parser.add_argument('--tag', type=str, action='append', help='runs must have this tag, can be repeated')
+    query_parser.add_argument('--where', type=str, action='append',
+                              help='condition on an atom or timestamp of the form `path operator value`, e.g. '
+                                   '"val/acc > 0.9", can be repeated. Operators are >, >=, <, <=, =, !=')
+
+    # merge_parser arguments
+    merge_parser.add_argument('--sources', type=str, nargs='+', help='paths to the shard archives')
+    merge_parser.add_argument('--destination', type=str,
+                              help='path of the merged archive, a directory or a .zip container. Must not exist')
+    merge_parser.add_argument('--num-workers', type=int, default=None,
+                              help='number of threads copying members. If None, the number of CPUs')
+
+    # verify_parser arguments
+    verify_parser.add_argument('--source', type=str, help='path to neptune archive')
+    verify_parser.add_argument('--project-id', type=str, default=None,
+                               help='if given, the archive is also compared with this project, using attribute paths, '
+                                    'atom values, last values of series and file sizes')
+    verify_parser.add_argument('--num-workers', type=int, default=None,
+                               help='number of threads hashing members and comparing runs. If None, the number of CPUs')
+    verify_parser.add_argument('--check-series-lengths', action='store_true',
+                               help='also compare the number of points of every series, which needs one request per '
+                                    'series')
     args = parser.parse_args()
 
 
@@ -69,6 +262,14 @@ def main():
         archive(args)
     elif args.command == 'retrieve':
         retrieve(args)
+    elif args.command == 'ls':
+        ls(args)
+    elif args.command == 'query':
+        query(args)
+    elif args.command == 'merge':
+        merge(args)
+    elif args.command == 'verify':
+        verify(args)
     else:
         parser.print_help()
 
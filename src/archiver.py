@@ -3,60 +3,214 @@ from pathlib import Path
 from neptune.attributes import FileSet, Boolean, Datetime, File, Float, GitRef, Integer, NotebookRef, RunState, String, \
     Artifact, FloatSeries, StringSeries, FileSeries, StringSet
 import uuid
+import inspect
 import json
 from src import __version__
 import zipfile
 import src.utils as utils
 from src.utils import RemoteKeys
+from src.catalog import Catalog
+from src.metrics import Metrics, Timings
+from src.scheduler import RequestScheduler
+from src.storage import COMPRESSED_SUFFIX, ZIP_SUFFIX, blob_name, hash_file, is_blob_reference, join_name, open_archive, \
+    sanitize_name
 from typing import Optional
 from neptune.exceptions import FetchAttributeNotFoundException
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
 import os
 import logging
+import pandas as pd
+import shutil
+import threading
+import time
+import zlib
 
 
 os.environ["TQDM_DISABLE"] = "1"  # disables TQDM output to make sys prints clearer
+PENDING_RUNS_PER_THREAD = 2  # runs submitted ahead of the threads archiving them, bounds table rows held in memory
 
 
 class Archiver:
-    def __init__(self, destination: Path, archive_name=None, project_id: Optional[str] = None, num_threads=1):
+    def __init__(self, destination: Path, archive_name=None, project_id: Optional[str] = None, num_threads=1,
+                 incremental=False, series_format=utils.SeriesFormats.CSV, container=None, series_chunk_size=None,
+                 metrics_file=None, progress=False, run_ids=None, retries=3, adaptive_concurrency=True, shard=None,
+                 runs_page_size=1000, compression=None, skip_project=False):
+        if incremental and container:
+            raise ValueError('Incremental archiving is only supported for directory archives.')
+        if series_format == utils.SeriesFormats.PARQUET:
+            utils.require_module('pyarrow', '--series-format parquet')
+        if compression == utils.CompressionFormats.ZSTD:
+            utils.require_module('zstandard', '--compression zstd')
         self.project_id = project_id
         self.project = neptune.init_project(project=self.project_id, mode='read-only')
-        self.runs_table = self.project.fetch_runs_table().to_pandas()
-        self.run_ids = self.runs_table.loc[:, 'sys/id'].tolist()
+        # the runs table is fetched in pages of runs_page_size runs while runs are archived, see iter_runs_table
+        self.runs_page_size = runs_page_size
+        self.selected_run_ids = run_ids  # if given, only these runs are archived, e.g. runs that failed before
+        # shard is (index, count). A shard archive holds the runs whose shard_of is index, only shard 0 holds the
+        # project structure. Shard archives are combined with Merger.
+        self.shard = shard
+        self.skip_project = skip_project  # e.g. for an archive of failed runs, which is merged with the original one
         if not archive_name:
             archive_name = self.project['sys/name'].fetch()
-        self.destination = destination / archive_name
+        if shard is not None:
+            archive_name += f'-shard-{shard[0]}-of-{shard[1]}'
+        self.destination = destination / (archive_name + ZIP_SUFFIX if container == utils.ContainerFormats.ZIP
+                                          else archive_name)
         self.num_threads = num_threads
-        self.destination.mkdir()
-        utils.configure_logging(self.destination / 'archiving.log')
+        # series, files and file sets of all runs are downloaded through this shared pool, so num_threads bounds the
+        # number of concurrent downloads regardless of how many runs are archived at the same time
+        self.attribute_executor = ThreadPoolExecutor(num_threads)
+        self.incremental = incremental
+        self.series_format = series_format
+        self.series_chunk_size = series_chunk_size
+        # with compression, structures, csv series and the log are stored zstd compressed, see compress_stream
+        self.compression = compression
+        # incremental mode continues an existing archive
+        self.storage = open_archive(self.destination, mode='w', exist_ok=incremental)
+        utils.configure_logging(self.storage.staging_path(utils.ARCHIVING_LOG))
+        self.catalog = Catalog(self.storage.staging_path(utils.CATALOG))
+        self.manifest_lock = threading.Lock()
+        self.archived_runs = self.load_manifest() if incremental else {}
+        # timings per attribute type of every run are written to metrics_file, progress is printed to stderr
+        self.metrics = Metrics(metrics_file, progress, executor=self.attribute_executor)
+        # every request to neptune goes through the scheduler, which retries transient failures and, if
+        # adaptive_concurrency is set, lowers the number of concurrent requests below num_threads while neptune
+        # throttles
+        self.scheduler = RequestScheduler(max_concurrency=num_threads, retries=retries, adaptive=adaptive_concurrency,
+                                          metrics=self.metrics)
 
     def archive(self, store_runs_table=True):
+        # Returns the ids of runs that could not be archived
         self.make_archive_log()
-        self.archive_project()
-        self.archive_runs()
-        if store_runs_table:
-            self.runs_table.to_csv(path_or_buf=self.destination / utils.RUNS_TABLE, index=False)
+        with self.storage.temp_dir() as runs_table_dir:
+            with self.attribute_executor:
+                if not self.skip_project and (self.shard is None or self.shard[0] == 0):
+                    self.archive_project()
+                failed_runs = self.archive_runs(Path(runs_table_dir) if store_runs_table else None)
+            if self.incremental:
+                self.remove_unreferenced_blobs()
+            if store_runs_table:
+                utils.concat_csv_files(sorted(Path(runs_table_dir).glob('*.csv')),
+                                       self.storage.staging_path(utils.RUNS_TABLE))
+        if self.compression:
+            utils.stop_logging(self.storage.staging_path(utils.ARCHIVING_LOG))
+            self.storage.compress_staged(utils.ARCHIVING_LOG)
+        self.catalog.close()
+        self.metrics.close()
+        self.storage.close()
+        return failed_runs
 
     def archive_project(self):
-        project_neptune_structure = self.project.get_structure()
-        neptune_obj_archiver = NeptuneObjArchiver(self.destination)
+        start = time.perf_counter()
+        project_neptune_structure = self.scheduler.call('structure', self.project.get_structure)
+        neptune_obj_archiver = NeptuneObjArchiver(self.storage, executor=self.attribute_executor,
+                                                  series_format=self.series_format,
+                                                  series_chunk_size=self.series_chunk_size, metrics=self.metrics,
+                                                  scheduler=self.scheduler, compression=self.compression)
         neptune_obj_archiver.archive(project_neptune_structure, utils.PROJECT_STRUCTURE)
+        self.metrics.record('project', seconds=round(time.perf_counter() - start, 3),
+                            attributes=neptune_obj_archiver.timings.as_dict())
 
-    def archive_runs(self):
+    def archive_runs(self, runs_table_dir=None):
+        # Runs are archived while the runs table is still being fetched. Pages of the runs table are written to
+        # runs_table_dir, if given, and only a bounded number of rows waits for a thread at any time.
+        failed_runs = []
+        submitted_runs = 0
         with ThreadPoolExecutor(self.num_threads) as executor:
-            for run_id in self.run_ids:
-                executor.submit(self.archive_run, run_id)
+            futures = {}
+            for page_number, runs_page in enumerate(iter_runs_table(self.project, self.runs_page_size,
+                                                                    self.scheduler)):
+                if runs_table_dir is not None:
+                    shard_page = runs_page.loc[runs_page['sys/id'].map(self.in_shard)]
+                    shard_page.to_csv(path_or_buf=runs_table_dir / f'{page_number:08d}.csv', index=False)
+                for table_row in runs_page.to_dict('records'):
+                    run_id = table_row['sys/id']
+                    modification_time = str(table_row['sys/modification_time'])
+                    if not self.is_selected(run_id, modification_time):
+                        logging.info(f'Skipping {run_id}, unchanged since last archiving or not selected')
+                        continue
+                    if len(futures) >= PENDING_RUNS_PER_THREAD * self.num_threads:
+                        for future in wait(futures, return_when=FIRST_COMPLETED).done:
+                            self.collect_run(future, futures.pop(future), failed_runs)
+                    futures[executor.submit(self.archive_run, run_id, modification_time, table_row)] = run_id
+                    submitted_runs += 1
+            self.metrics.total_runs = submitted_runs
+            for future in as_completed(futures):
+                self.collect_run(future, futures[future], failed_runs)
+        return sorted(failed_runs)
 
-    def archive_run(self, run_id):
+    @staticmethod
+    def collect_run(future, run_id, failed_runs):
+        try:
+            future.result()
+        except Exception as exception:
+            # the run has no manifest entry, so incremental archiving archives it again
+            logging.error(f'Archiving {run_id} failed: {type(exception).__name__}: {exception}')
+            print(f'Archiving run {run_id} failed: {exception}')
+            failed_runs.append(run_id)
+
+    def is_selected(self, run_id, modification_time):
+        return (self.selected_run_ids is None or run_id in self.selected_run_ids) and self.in_shard(run_id) and \
+            self.archived_runs.get(run_id) != modification_time
+
+    def in_shard(self, run_id):
+        return self.shard is None or shard_of(run_id, self.shard[1]) == self.shard[0]
+
+    def archive_run(self, run_id, modification_time, table_row=None):
         logging.info(f'Start archiving {run_id}')
-        run = neptune.init_run(with_id=run_id, project=self.project_id, mode='read-only')
-        run_neptune_structure = run.get_structure()
-        (self.destination / run_id).mkdir()
-        neptune_obj_archiver = NeptuneObjArchiver(destination=self.destination / run_id)
-        neptune_obj_archiver.archive(run_neptune_structure, utils.RUN_STRUCTURE)
-        run.stop()
-        logging.info(f'Finished archiving {run_id}')
+        start = time.perf_counter()
+        neptune_obj_archiver = NeptuneObjArchiver(self.storage, prefix=run_id, executor=self.attribute_executor,
+                                                  table_row=table_row, series_format=self.series_format,
+                                                  series_chunk_size=self.series_chunk_size, metrics=self.metrics,
+                                                  scheduler=self.scheduler, compression=self.compression)
+        run = None
+        failed = True
+        try:
+            with neptune_obj_archiver.timings.measure('structure'):
+                run = self.scheduler.call('init_run', neptune.init_run, with_id=run_id, project=self.project_id,
+                                          mode='read-only')
+                run_neptune_structure = self.scheduler.call('structure', run.get_structure)
+            if self.incremental and self.storage.exists(run_id):  # modified run or leftover of an interrupted archiving
+                self.storage.remove(run_id)
+            neptune_obj_archiver.archive(run_neptune_structure, utils.RUN_STRUCTURE)
+            run.stop()
+            run = None
+            with neptune_obj_archiver.timings.measure('catalog'):
+                self.catalog.add_run(run_id, neptune_obj_archiver.local_structure, self.storage,
+                                     neptune_obj_archiver.series_metadata)
+            self.add_to_manifest(run_id, modification_time)
+            failed = False
+        finally:
+            if run is not None:
+                run.stop()
+            seconds = time.perf_counter() - start
+            self.metrics.run_finished(run_id, seconds, neptune_obj_archiver.timings, failed=failed)
+        logging.info(f'Finished archiving {run_id} in {seconds:.2f}s')
+
+    def remove_unreferenced_blobs(self):
+        # runs archived again replace their run directory, blobs only the replaced version referred to are removed once
+        # all runs are archived, as runs archived concurrently may share them
+        unreferenced_blobs = self.storage.list_unreferenced_blobs()
+        for name in unreferenced_blobs:
+            self.storage.remove(name)
+        if unreferenced_blobs:
+            logging.info(f'Removed {len(unreferenced_blobs)} blob(s) no structure refers to')
+
+    def load_manifest(self):
+        # the manifest is append-only, so later entries of a run override earlier ones
+        archived_runs = {}
+        manifest_path = self.storage.staging_path(utils.ARCHIVE_MANIFEST)
+        if manifest_path.exists():
+            with manifest_path.open('r') as manifest_file:
+                for line in manifest_file:
+                    if line.strip():
+                        entry = json.loads(line)
+                        archived_runs[entry['run_id']] = entry['modification_time']
+        return archived_runs
+
+    def add_to_manifest(self, run_id, modification_time):
+        with self.manifest_lock, self.storage.staging_path(utils.ARCHIVE_MANIFEST).open('a') as manifest_file:
+            manifest_file.write(json.dumps({'run_id': run_id, 'modification_time': modification_time}) + '\n')
 
     def make_archive_log(self):
         logging.info(f'archiver_version: {__version__}')
@@ -65,15 +219,42 @@ class Archiver:
 
 
 class NeptuneObjArchiver:
-    # Class is used to recursively crawl through a neptune object (run or project) and store all data at a local
-    # directory
-    def __init__(self, destination):
+    # Class is used to recursively crawl through a neptune object (run or project) and store all data in an archive
+    # storage, below prefix. If an executor is given, downloads of series, files and file sets are scheduled on it.
+    # Atom values found in table_row (the object's row of the runs table) are taken from there instead of being fetched
+    # one by one. With the parquet series format, all float (string) series of the object share one parquet file. If
+    # series_chunk_size is given, series are fetched and written in chunks of that many points. Time and bytes per
+    # attribute type are collected in timings, every download is also recorded as an event of metrics. Requests to
+    # neptune are made through scheduler, which limits their concurrency and retries transient failures. With
+    # compression, the structure and csv series are written zstd compressed.
+    def __init__(self, storage, prefix='', executor=None, table_row=None, series_format=utils.SeriesFormats.CSV,
+                 series_chunk_size=None, metrics=None, scheduler=None, compression=None):
         self.local_structure = {remote_key.value: {} for remote_key in RemoteKeys}
-        self.destination = destination
+        self.storage = storage
+        self.prefix = prefix
+        self.executor = executor
+        self.table_row = table_row or {}
+        self.series_format = series_format
+        self.series_chunk_size = series_chunk_size
+        self.member_suffix = COMPRESSED_SUFFIX if compression else ''
+        self.series_metadata = {}  # attribute path -> (number of points, last step, last value), used by the catalog
+        self.pending_fetches = []
+        self.parquet_writers = {}
+        self.parquet_lock = threading.Lock()
+        self.metrics = metrics or Metrics()
+        self.scheduler = scheduler or RequestScheduler(metrics=self.metrics)
+        self.timings = Timings()
 
     def archive(self, neptune_structure, string_id):
-        self.traverse_neptune_structure(neptune_structure)
-        with (self.destination / string_id).open(mode='w') as json_file:
+        try:
+            self.traverse_neptune_structure(neptune_structure)
+            self.collect_pending_fetches()
+        finally:
+            for parquet_writer, parquet_file in self.parquet_writers.values():
+                parquet_writer.close()
+                parquet_file.close()
+        with self.timings.measure('write_structure'), \
+                self.storage.open(join_name(self.prefix, string_id + self.member_suffix), mode='w') as json_file:
             json.dump(self.local_structure, json_file, indent=4)
 
     def traverse_neptune_structure(self, neptune_structure, concatenated_key=''):
@@ -86,29 +267,36 @@ class NeptuneObjArchiver:
     def fetch(self, value, concatenated_key):
         concatenated_key = concatenated_key[1:]  # remove first /
         if isinstance(value, (Boolean, Float, Integer, String)):
-            self.local_structure[RemoteKeys.ATOMS.value][concatenated_key] = value.fetch()
+            with self.timings.measure(RemoteKeys.ATOMS.value):
+                self.local_structure[RemoteKeys.ATOMS.value][concatenated_key] = self.fetch_atom(value,
+                                                                                                 concatenated_key)
         elif isinstance(value, Datetime):
-            self.local_structure[RemoteKeys.TIME_STAMPS.value][concatenated_key] = value.fetch().timestamp()
+            with self.timings.measure(RemoteKeys.TIME_STAMPS.value):
+                self.local_structure[RemoteKeys.TIME_STAMPS.value][concatenated_key] = \
+                    self.fetch_datetime(value, concatenated_key)
         elif isinstance(value, StringSet):
             # TODO group tags bugged for some reason
-            try:
-                string_set = list(value.fetch())
-            except FetchAttributeNotFoundException as exception:
-                logging.warning(  f'During fetching {concatenated_key}, an exception has occurred. '
-                                  f'Setting {concatenated_key} to empty list: {exception}')
-                string_set = []
+            with self.timings.measure(RemoteKeys.STRING_SETS.value):
+                try:
+                    string_set = list(self.scheduler.call('string_set', value.fetch))
+                except FetchAttributeNotFoundException as exception:
+                    logging.warning(  f'During fetching {concatenated_key}, an exception has occurred. '
+                                      f'Setting {concatenated_key} to empty list: {exception}')
+                    string_set = []
             self.local_structure[RemoteKeys.STRING_SETS.value][concatenated_key] = string_set
         elif isinstance(value, FloatSeries):
-            self.local_structure[RemoteKeys.FLOAT_SERIES.value][concatenated_key] = self.fetch_series(value)
+            self.schedule_fetch(RemoteKeys.FLOAT_SERIES, concatenated_key, self.fetch_series, value,
+                                concatenated_key, RemoteKeys.FLOAT_SERIES)
         elif isinstance(value, StringSeries):
-            self.local_structure[RemoteKeys.STRING_SERIES.value][concatenated_key] = self.fetch_series(value)
+            self.schedule_fetch(RemoteKeys.STRING_SERIES, concatenated_key, self.fetch_series, value,
+                                concatenated_key, RemoteKeys.STRING_SERIES)
         elif isinstance(value, File):
-            self.local_structure[RemoteKeys.FILES.value][concatenated_key] = self.fetch_file(value)
+            self.schedule_fetch(RemoteKeys.FILES, concatenated_key, self.fetch_file, value)
         elif isinstance(value, FileSet):
-            self.local_structure[RemoteKeys.FILE_SETS.value][concatenated_key] = self.fetch_fileset(value)
+            self.schedule_fetch(RemoteKeys.FILE_SETS, concatenated_key, self.fetch_fileset, value)
         elif isinstance(value, FileSeries):
             #  TODO Figure out how to deal with descriptions/names of file series elements
-            self.local_structure[RemoteKeys.FILE_SERIES.value][concatenated_key] = self.fetch_file(value)
+            self.schedule_fetch(RemoteKeys.FILE_SERIES, concatenated_key, self.fetch_file_series, value)
         elif isinstance(value, RunState):
             pass  # RunState should not be logged as it is not mutable on client side
         elif isinstance(value, GitRef):
@@ -117,31 +305,231 @@ class NeptuneObjArchiver:
         else:
             raise NameError("Unknown Type", value, " ", type(value))
 
-    def fetch_series(self, series):
-        series_df = series.fetch_values()
-        file_id = str(uuid.uuid4()) + '.csv'
+    def get_table_value(self, concatenated_key):
+        table_value = self.table_row.get(concatenated_key)
+        if table_value is None or pd.isna(table_value):
+            return None
+        return table_value
+
+    def fetch_atom(self, atom, concatenated_key):
+        table_value = self.get_table_value(concatenated_key)
+        if table_value is None:
+            return self.scheduler.call('atom', atom.fetch)
+        if isinstance(atom, Boolean):
+            return bool(table_value)
+        if isinstance(atom, Integer):
+            if isinstance(table_value, float) and abs(table_value) > 2 ** 53:  # int column upcast to float lost digits
+                return self.scheduler.call('atom', atom.fetch)
+            return int(table_value)
+        if isinstance(atom, Float):
+            return float(table_value)
+        return str(table_value)
+
+    def fetch_datetime(self, datetime_attribute, concatenated_key):
+        table_value = self.get_table_value(concatenated_key)
+        if table_value is None:
+            return self.scheduler.call('atom', datetime_attribute.fetch).timestamp()
+        return utils.table_datetime_to_timestamp(table_value)
+
+    def schedule_fetch(self, remote_key, concatenated_key, fetch_function, *args):
+        if self.executor is None:
+            self.local_structure[remote_key.value][concatenated_key] = \
+                self.timed_fetch(remote_key, concatenated_key, time.perf_counter(), None, fetch_function, *args)
+        else:
+            future = self.executor.submit(self.timed_fetch, remote_key, concatenated_key, time.perf_counter(),
+                                          self.metrics.queue_depth(), fetch_function, *args)
+            self.pending_fetches.append((remote_key, concatenated_key, future))
+
+    def timed_fetch(self, remote_key, concatenated_key, submit_time, queue_depth, fetch_function, *args):
+        start = time.perf_counter()
+        result = fetch_function(*args)
+        seconds = time.perf_counter() - start
+        transferred_bytes = self.get_stored_size(result)
+        points = self.series_metadata.get(concatenated_key, (0,))[0] \
+            if remote_key in (RemoteKeys.FLOAT_SERIES, RemoteKeys.STRING_SERIES) else 0
+        self.timings.add(remote_key.value, seconds, transferred_bytes=transferred_bytes, points=points)
+        self.metrics.record('attribute', object=self.prefix, path=concatenated_key, type=remote_key.value,
+                            seconds=round(seconds, 3), wait_seconds=round(start - submit_time, 3),
+                            queue_depth=queue_depth, bytes=transferred_bytes, points=points)
+        return result
+
+    def get_stored_size(self, result):
+        # bytes of the files or series file a fetch stored, series in shared parquet files are not counted
+        if result is None:
+            return 0
+        if isinstance(result, dict):
+            return sum(self.storage.size(blob_name(reference)) for reference in result.values())
+        if is_blob_reference(result):
+            return self.storage.size(blob_name(result))
+        if result.endswith('.parquet'):
+            return 0
+        return self.storage.size(join_name(self.prefix, result))
+
+    def collect_pending_fetches(self):
+        # wait for all downloads before raising, so that no task keeps writing to the destination after a failure
+        wait([future for _, _, future in self.pending_fetches])
+        for remote_key, concatenated_key, future in self.pending_fetches:
+            self.local_structure[remote_key.value][concatenated_key] = future.result()
+        self.pending_fetches = []
+
+    def fetch_series(self, series, concatenated_key, remote_key):
+        if self.series_chunk_size:
+            return self.fetch_series_chunked(series, concatenated_key, remote_key)
+        series_df = self.scheduler.call(None, series.fetch_values)
         if not len(series_df.columns) == 0:  # neptune returns an empty dataframe with no columns for when a monitoring
             # string series is empty. Not sure what happens to other series empty series, so the condition is if there
             # are no column names. Then return None such that Restorer knows what to do.
-            series_df['timestamp'] = series_df['timestamp'].apply(lambda x: x.to_pydatetime().timestamp())
-            series_df.to_csv(path_or_buf=self.destination / file_id, index=False)
+            series_df['timestamp'] = utils.datetimes_to_timestamps(series_df['timestamp'])
+            self.series_metadata[concatenated_key] = (len(series_df), series_df['step'].iloc[-1],
+                                                      series_df['value'].iloc[-1])
+            if self.series_format == utils.SeriesFormats.PARQUET:
+                return self.write_parquet_series(series_df, concatenated_key, remote_key)
+            file_id = str(uuid.uuid4()) + '.csv' + self.member_suffix
+            with self.storage.open(join_name(self.prefix, file_id), mode='w') as csv_file:
+                series_df.to_csv(path_or_buf=csv_file, index=False)
             return file_id
         return None
 
-    def fetch_file_series(self, file_series):
-        file_id = str(uuid.uuid4())
-        file_series.download(str(self.destination / file_id))
+    def fetch_series_chunked(self, series, concatenated_key, remote_key):
+        # only one chunk per series is held in memory, empty series are stored as None like in fetch_series
+        file_id = None
+        csv_file = None
+        points = 0
+        try:
+            for series_df in iter_series_chunks(series, self.series_chunk_size, self.scheduler):
+                points += len(series_df)
+                self.series_metadata[concatenated_key] = (points, series_df['step'].iloc[-1],
+                                                          series_df['value'].iloc[-1])
+                if self.series_format == utils.SeriesFormats.PARQUET:
+                    file_id = self.write_parquet_series(series_df, concatenated_key, remote_key)
+                elif csv_file is None:
+                    file_id = str(uuid.uuid4()) + '.csv' + self.member_suffix
+                    csv_file = self.storage.open(join_name(self.prefix, file_id), mode='w')
+                    series_df.to_csv(path_or_buf=csv_file, index=False)
+                else:
+                    series_df.to_csv(path_or_buf=csv_file, index=False, header=False)
+        finally:
+            if csv_file is not None:
+                csv_file.close()
         return file_id
 
-    def fetch_fileset(self, fileset):
-        file_id = str(uuid.uuid4())
-        fileset.download(str(self.destination / (file_id + '.zip')))
-        with zipfile.ZipFile(self.destination / (file_id + '.zip'), 'r') as zip_ref:
-            zip_ref.extractall(self.destination / file_id)
-        (self.destination / (file_id + '.zip')).unlink()
+    def write_parquet_series(self, series_df, concatenated_key, remote_key):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        value_type = pa.float64() if remote_key == RemoteKeys.FLOAT_SERIES else pa.string()
+        schema = pa.schema([('path', pa.string()), ('step', pa.float64()), ('value', value_type),
+                            ('timestamp', pa.float64())])
+        series_df = series_df.loc[:, ['step', 'value', 'timestamp']]
+        series_df.insert(0, 'path', concatenated_key)
+        table = pa.Table.from_pandas(series_df, schema=schema, preserve_index=False)
+        file_id = utils.PARQUET_SERIES_FILES[remote_key]
+        with self.parquet_lock:
+            if remote_key not in self.parquet_writers:
+                parquet_file = self.storage.open(join_name(self.prefix, file_id), mode='wb')
+                self.parquet_writers[remote_key] = (pq.ParquetWriter(parquet_file, schema, compression='zstd'),
+                                                    parquet_file)
+            # every series is written as its own row groups, so the path statistics let readers skip other series
+            self.parquet_writers[remote_key][0].write_table(table)
         return file_id
 
+    # Files are stored as content-addressed blobs shared by all objects of the archive. The structure references a file
+    # by the hash of its content, file sets and file series by a mapping of their member names to hashes.
+    def fetch_file_series(self, file_series):
+        with self.storage.temp_dir() as temp_dir:
+            self.scheduler.call(None, file_series.download, str(Path(temp_dir) / 'file_series'))
+            return self.store_directory(Path(temp_dir) / 'file_series')
+
+    def fetch_fileset(self, fileset):
+        # neptune serves file sets as zip, its members are hashed and stored without extracting the zip first
+        members = {}
+        with self.storage.temp_dir() as temp_dir:
+            self.scheduler.call(None, fileset.download, str(Path(temp_dir) / 'fileset.zip'))
+            with zipfile.ZipFile(Path(temp_dir) / 'fileset.zip', 'r') as zip_ref:
+                for member in zip_ref.infolist():
+                    member_name = sanitize_name(member.filename)
+                    if member.is_dir() or member_name is None:
+                        continue
+                    with zip_ref.open(member) as source, open(Path(temp_dir) / 'member', 'wb') as target:
+                        shutil.copyfileobj(source, target)
+                    members[member_name] = self.store_blob(Path(temp_dir) / 'member')
+        return members
+
     def fetch_file(self, file):
-        file_id = str(uuid.uuid4())
-        file.download(str(self.destination / file_id))
-        return file_id
+        with self.storage.temp_dir() as temp_dir:
+            self.scheduler.call(None, file.download, str(Path(temp_dir) / 'file'))
+            return self.store_blob(Path(temp_dir) / 'file')
+
+    def store_directory(self, directory):
+        return {file.relative_to(directory).as_posix(): self.store_blob(file)
+                for file in sorted(directory.rglob('*')) if file.is_file()}
+
+    def store_blob(self, path):
+        reference = hash_file(path)
+        self.storage.add_blob(blob_name(reference), path)
+        return reference
+
+
+def iter_runs_table(project, page_size, scheduler):
+    # Yields the runs table in pages of at most page_size runs, in order of creation. Every page is requested from the
+    # creation time the previous page ended with, runs of that time which were already yielded are dropped. Creation
+    # times without time zone are taken as UTC, like neptune returns them. Clients without paging (neptune < 1.9)
+    # fetch the whole table at once.
+    if 'limit' not in inspect.signature(project.fetch_runs_table).parameters:
+        logging.warning('The neptune client does not support paging, fetching the whole runs table at once')
+        yield scheduler.call(None, lambda: project.fetch_runs_table().to_pandas())
+        return
+    last_creation_time = None
+    seen_run_ids = set()
+    while True:
+        query = None if last_creation_time is None else \
+            f'(`sys/creation_time`:datetime >= "{last_creation_time.strftime("%Y-%m-%dT%H:%M:%S.%fZ")}")'
+        runs_page = scheduler.call('runs_table', fetch_runs_table_page, project, query, page_size)
+        if len(runs_page) == 0:
+            return
+        new_runs_page = runs_page.loc[~runs_page['sys/id'].isin(seen_run_ids)]
+        if len(new_runs_page) > 0:
+            yield new_runs_page
+        if len(runs_page) < page_size:
+            return
+        creation_times = pd.to_datetime(runs_page['sys/creation_time'], utc=True)  # see table_datetime_to_timestamp
+        if len(new_runs_page) == 0:
+            raise RuntimeError(f'{page_size} or more runs were created at {creation_times.max()}, increase the runs '
+                               f'page size.')
+        if creation_times.max() != last_creation_time:
+            last_creation_time = creation_times.max()
+            seen_run_ids = set()
+        seen_run_ids.update(runs_page.loc[(creation_times == last_creation_time).to_numpy(), 'sys/id'])
+
+
+def fetch_runs_table_page(project, query, limit):
+    return project.fetch_runs_table(query=query, sort_by='sys/creation_time', ascending=True,
+                                    limit=limit).to_pandas()
+
+
+def shard_of(run_id, shard_count):
+    # stable across processes and hosts, unlike hash()
+    return zlib.crc32(run_id.encode('utf-8')) % shard_count
+
+
+def iter_series_chunks(series, chunk_size, scheduler):
+    # neptune's public api only returns whole series, so the paged backend call behind fetch_values is used directly.
+    # Every page is requested through the scheduler, so a transient failure only repeats the failed page.
+    if not hasattr(series, '_fetch_values_from_backend'):
+        series_df = scheduler.call(None, series.fetch_values)
+        if len(series_df.columns) == 0:
+            return
+        series_df['timestamp'] = utils.datetimes_to_timestamps(series_df['timestamp'])
+        for start in range(0, len(series_df), chunk_size):
+            yield series_df.iloc[start:start + chunk_size]
+        return
+    offset = 0
+    while True:
+        series_values = scheduler.call('series_page', series._fetch_values_from_backend, offset, chunk_size)
+        if not series_values.values:
+            return
+        yield pd.DataFrame({'step': [point.step for point in series_values.values],
+                            'value': [point.value for point in series_values.values],
+                            'timestamp': [point.timestampMillis / 1000 for point in series_values.values]})
+        offset += len(series_values.values)
+        if offset >= series_values.totalItemCount:
+            return
@@ -0,0 +1,172 @@
+import re
+import sqlite3
+import tempfile
+import threading
+from pathlib import Path
+import src.utils as utils
+from src.utils import RemoteKeys
+from src.storage import blob_name, is_blob_reference, join_name
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (run_id TEXT PRIMARY KEY, creation_time REAL, modification_time REAL);
+CREATE TABLE IF NOT EXISTS atoms (run_id TEXT, path TEXT, value, PRIMARY KEY (run_id, path));
+CREATE TABLE IF NOT EXISTS string_sets (run_id TEXT, path TEXT, value TEXT);
+CREATE TABLE IF NOT EXISTS attributes (run_id TEXT, path TEXT, type TEXT, member TEXT, location TEXT, size INTEGER);
+CREATE TABLE IF NOT EXISTS series (run_id TEXT, path TEXT, points INTEGER, last_step REAL, last_value,
+                                   PRIMARY KEY (run_id, path));
+CREATE INDEX IF NOT EXISTS atoms_path_value ON atoms (path, value);
+CREATE INDEX IF NOT EXISTS string_sets_path_value ON string_sets (path, value);
+CREATE INDEX IF NOT EXISTS string_sets_run_id ON string_sets (run_id);
+CREATE INDEX IF NOT EXISTS attributes_run_id ON attributes (run_id);
+'''
+
+TABLES = ('runs', 'atoms', 'string_sets', 'attributes', 'series')
+CONDITION_PATTERN = re.compile(r'^\s*(.+?)\s*(>=|<=|!=|==|=|>|<)\s*(.+?)\s*$')
+BOOLEAN_VALUES = {'true': 1.0, 'false': 0.0}
+SQL_OPERATORS = {'>=': '>=', '<=': '<=', '!=': '!=', '==': '=', '=': '=', '>': '>', '<': '<'}
+BLOB_ATTRIBUTE_KEYS = (RemoteKeys.FLOAT_SERIES, RemoteKeys.STRING_SERIES, RemoteKeys.FILES, RemoteKeys.FILE_SETS,
+                       RemoteKeys.FILE_SERIES)
+
+
+class Catalog:
+    # SQLite index of the runs of an archive: their atoms and timestamps, string sets (tags), length and last value of
+    # their series and the archive members holding their series and files. Allows to query an archive without reading
+    # every run_structure.json.
+    def __init__(self, path, temp_dir=None):
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.temp_dir = temp_dir  # keeps catalogs extracted from zip archives alive
+        self.lock = threading.Lock()
+        with self.connection:
+            self.connection.executescript(SCHEMA)
+
+    @classmethod
+    def open(cls, storage):
+        if not storage.exists(utils.CATALOG):
+            raise FileNotFoundError(f'Archive has no {utils.CATALOG}, it was created by an older archiver version.')
+        temp_dir = tempfile.TemporaryDirectory()
+        return cls(storage.local_path(utils.CATALOG, Path(temp_dir.name)), temp_dir)
+
+    def add_run(self, run_id, local_structure, storage, series_metadata=None):
+        time_stamps = local_structure[RemoteKeys.TIME_STAMPS.value]
+        atoms = list(local_structure[RemoteKeys.ATOMS.value].items()) + list(time_stamps.items())
+        string_sets = [(path, value) for path, values in local_structure[RemoteKeys.STRING_SETS.value].items()
+                       for value in values]
+        attributes = [(path, remote_key.value, member, location, self.get_size(storage, location))
+                      for remote_key in BLOB_ATTRIBUTE_KEYS
+                      for path, member, location in iter_locations(local_structure[remote_key.value], run_id)]
+        series = [(run_id, path, int(points), float(last_step), to_sql_value(last_value))
+                  for path, (points, last_step, last_value) in (series_metadata or {}).items()]
+        with self.lock, self.connection:
+            # the run may have been archived before
+            for table in TABLES:
+                self.connection.execute(f'DELETE FROM {table} WHERE run_id = ?', (run_id,))
+            self.connection.execute('INSERT INTO runs VALUES (?, ?, ?)', (run_id, time_stamps.get('sys/creation_time'),
+                                                                         time_stamps.get('sys/modification_time')))
+            self.connection.executemany('INSERT INTO atoms VALUES (?, ?, ?)',
+                                        [(run_id, path, value) for path, value in atoms])
+            self.connection.executemany('INSERT INTO string_sets VALUES (?, ?, ?)',
+                                        [(run_id, path, value) for path, value in string_sets])
+            self.connection.executemany('INSERT INTO attributes VALUES (?, ?, ?, ?, ?, ?)',
+                                        [(run_id, *attribute) for attribute in attributes])
+            self.connection.executemany('INSERT INTO series VALUES (?, ?, ?, ?, ?)', series)
+
+    def add_catalog(self, path):
+        # adds all runs of the catalog at path, e.g. of a shard archive, replacing runs that are in both
+        with self.lock:
+            self.connection.execute('ATTACH DATABASE ? AS other', (str(path),))
+            try:
+                with self.connection:
+                    for table in TABLES:
+                        self.connection.execute(f'DELETE FROM {table} WHERE run_id IN (SELECT run_id FROM other.runs)')
+                        self.connection.execute(f'INSERT INTO {table} SELECT * FROM other.{table}')
+            finally:
+                self.connection.execute('DETACH DATABASE other')
+
+    def get_series(self, run_id):
+        # returns {path: (number of points, last step, last value)}
+        with self.lock:
+            rows = self.connection.execute('SELECT path, points, last_step, last_value FROM series WHERE run_id = ?',
+                                           (run_id,)).fetchall()
+        return {path: (points, last_step, last_value) for path, points, last_step, last_value in rows}
+
+    def get_attributes(self, run_id, remote_key):
+        # returns [(path, member, size)]
+        with self.lock:
+            return self.connection.execute('SELECT path, member, size FROM attributes WHERE run_id = ? AND type = ?',
+                                           (run_id, remote_key.value)).fetchall()
+
+    @staticmethod
+    def get_size(storage, location):
+        # parquet files are shared by all series of a run, so they have no size per attribute
+        return None if location.endswith('.parquet') else storage.size(location)
+
+    def list_runs(self):
+        return self.connection.execute(
+            "SELECT runs.run_id, runs.creation_time, group_concat(string_sets.value, ',') FROM runs "
+            "LEFT JOIN string_sets ON string_sets.run_id = runs.run_id AND string_sets.path = 'sys/tags' "
+            "GROUP BY runs.run_id ORDER BY runs.creation_time").fetchall()
+
+    def query(self, tags=(), conditions=()):
+        # returns the ids of runs having all tags and fulfilling all conditions of the form `path operator value`,
+        # e.g. `val/acc > 0.9` or `sys/name = baseline`, on atoms, timestamps and last values of series
+        clauses, parameters = [], []
+        for tag in tags:
+            clauses.append('EXISTS (SELECT 1 FROM string_sets WHERE string_sets.run_id = runs.run_id '
+                           "AND string_sets.path = 'sys/tags' AND string_sets.value = ?)")
+            parameters.append(tag)
+        for condition in conditions:
+            # the value of an atom or the last value of a series
+            path, operator, value = parse_condition(condition)
+            clauses.append(f'({value_clause("atoms", "value", operator, value)} OR '
+                           f'{value_clause("series", "last_value", operator, value)})')
+            parameters.extend([path, value, path, value])
+        where = ' WHERE ' + ' AND '.join(clauses) if clauses else ''
+        return [row[0] for row in self.connection.execute(
+            f'SELECT runs.run_id FROM runs{where} ORDER BY runs.creation_time', parameters)]
+
+    def close(self):
+        self.connection.close()
+        if self.temp_dir is not None:
+            self.temp_dir.cleanup()
+
+
+def value_clause(table, column, operator, value):
+    # numbers only compare with numbers and text with text, like in python
+    type_check = f"typeof({table}.{column}) IN ('integer', 'real')" if isinstance(value, float) else \
+        f"typeof({table}.{column}) = 'text'"
+    return f'EXISTS (SELECT 1 FROM {table} WHERE {table}.run_id = runs.run_id AND {table}.path = ? ' \
+           f'AND {table}.{column} {SQL_OPERATORS[operator]} ? AND {type_check})'
+
+
+def parse_condition(condition):
+    match = CONDITION_PATTERN.match(condition)
+    if match is None:
+        raise ValueError(f'Condition "{condition}" is not of the form `path operator value`, '
+                         f'operators are {", ".join(SQL_OPERATORS)}.')
+    path, operator, value = match.groups()
+    if value.lower() in BOOLEAN_VALUES:  # booleans are stored as integers
+        return path, operator, BOOLEAN_VALUES[value.lower()]
+    try:
+        value = float(value)
+    except ValueError:
+        value = value.strip('"\'')
+    return path, operator, value
+
+
+def to_sql_value(value):
+    # numpy scalars of series dataframes are not supported by sqlite3
+    return value.item() if hasattr(value, 'item') else value
+
+
+def iter_locations(entries, source):
+    # yields (path, member, archive member name) for the entries of one type of a run structure
+    for path, entry in entries.items():
+        if entry is None:  # empty series
+            continue
+        if isinstance(entry, dict):
+            for member, reference in entry.items():
+                yield path, member, blob_name(reference)
+        elif is_blob_reference(entry):
+            yield path, '', blob_name(entry)
+        else:
+            yield path, '', join_name(source, entry)
@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import src.utils as utils
+from src.catalog import Catalog
+from src.storage import BLOBS_DIR, COMPRESSED_SUFFIX, open_archive
+
+# members that are combined from all shards instead of being copied
+COMBINED_MEMBERS = {utils.CHECKSUMS, utils.CATALOG, utils.ARCHIVE_MANIFEST, utils.RUNS_TABLE, utils.ARCHIVING_LOG,
+                    utils.ARCHIVING_LOG + COMPRESSED_SUFFIX}
+
+
+class Merger:
+    # Combines shard archives written with Archiver(shard=...), or an archive and an archive of its failed runs, into
+    # one archive at destination, a directory or a .zip container. Runs and the project structure are copied, blobs
+    # shared by several shards are stored once, and the runs tables, archive manifests, logs and catalogs of the shards
+    # are concatenated. Leftovers of runs that failed in a source are not copied. Checksums of the merged archive are
+    # written when it is closed.
+    def __init__(self, sources, destination: Path, num_workers=None):
+        self.sources = [open_archive(source) for source in sources]
+        self.destination = destination
+        self.num_workers = num_workers or os.cpu_count()
+
+    def merge(self):
+        members = self.get_members()
+        storage = open_archive(self.destination, mode='w')
+        try:
+            with ThreadPoolExecutor(self.num_workers) as executor:
+                # list() propagates the first exception
+                list(executor.map(lambda member: self.copy_member(storage, *member), members.items()))
+            self.merge_runs_tables(storage)
+            self.concatenate(storage, utils.ARCHIVE_MANIFEST)
+            self.concatenate(storage, utils.ARCHIVING_LOG)
+            self.concatenate(storage, utils.ARCHIVING_LOG + COMPRESSED_SUFFIX)  # zstd frames can be concatenated
+            self.merge_catalogs(storage)
+        finally:
+            storage.close()
+            for source in self.sources:
+                source.close()
+
+    def get_members(self):
+        # returns {member name: source storage}, blobs are taken from the first shard holding them
+        members = {}
+        for source in self.sources:
+            runs = set(source.list_runs())
+            for name in source.list_members():
+                if name in COMBINED_MEMBERS:
+                    continue
+                if '/' in name and not name.startswith(BLOBS_DIR + '/') and name.split('/', 1)[0] not in runs:
+                    continue  # written by a run that failed, it has no run structure
+                if name in members and not name.startswith(BLOBS_DIR + '/'):
+                    raise ValueError(f'{name} is in more than one shard archive. Shard archives of the same '
+                                     f'--shard count have disjoint runs and only shard 0 holds the project.')
+                members.setdefault(name, source)
+        if utils.PROJECT_STRUCTURE not in members and utils.PROJECT_STRUCTURE + COMPRESSED_SUFFIX not in members:
+            raise ValueError(f'No shard archive has a {utils.PROJECT_STRUCTURE}, shard 0 is missing.')
+        return members
+
+    @staticmethod
+    def copy_member(storage, name, source):
+        if name.startswith(BLOBS_DIR + '/'):
+            with storage.temp_dir() as temp_dir:  # blobs of directory archives are hard linked if possible
+                source.copy_to(name, Path(temp_dir) / 'blob')
+                storage.add_blob(name, Path(temp_dir) / 'blob')
+            return
+        with source.open_raw(name) as source_file, storage.open_raw(name, mode='wb') as target_file:
+            shutil.copyfileobj(source_file, target_file)
+
+    def merge_runs_tables(self, storage):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            runs_tables = [source.local_path(utils.RUNS_TABLE, Path(temp_dir) / str(position))
+                           for position, source in enumerate(self.sources) if source.exists(utils.RUNS_TABLE)]
+            if runs_tables:
+                utils.concat_csv_files(runs_tables, storage.staging_path(utils.RUNS_TABLE), key='sys/id')
+
+    def concatenate(self, storage, name):
+        # members are copied as stored, without decompressing them
+        sources = [source for source in self.sources if source.exists(name)]
+        if not sources:
+            return
+        with storage.staging_path(name).open('ab') as target_file:
+            for source in sources:
+                with source.open_raw(name) as source_file:
+                    shutil.copyfileobj(source_file, target_file)
+
+    def merge_catalogs(self, storage):
+        catalog = Catalog(storage.staging_path(utils.CATALOG))
+        try:
+            for source in self.sources:
+                if source.exists(utils.CATALOG):
+                    with tempfile.TemporaryDirectory() as temp_dir:
+                        catalog.add_catalog(source.local_path(utils.CATALOG, Path(temp_dir)))
+        finally:
+            catalog.close()
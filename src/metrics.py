@@ -0,0 +1,115 @@
+import contextlib
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import timedelta
+
+PROGRESS_INTERVAL = 1.0  # minimum seconds between two updates of the progress line
+
+
+class Metrics:
+    # Collects per-run timings, transferred bytes and counters (e.g. retries) of archiving or restoring. Events are
+    # appended to a JSON-lines file if a path is given and a progress line with runs done, throughput and ETA is written
+    # to stderr if progress is set. Queue depth is sampled from the executor the heavy downloads or uploads run on.
+    def __init__(self, path=None, progress=False, total_runs=None, executor=None):
+        self.file = open(path, 'a', encoding='utf-8') if path else None
+        self.progress = progress
+        self.total_runs = total_runs
+        self.executor = executor
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.last_progress_time = 0
+        self.runs_done = 0
+        self.runs_failed = 0
+        self.transferred_bytes = 0
+        self.counters = Counter()
+
+    def record(self, event, **fields):
+        if self.file is None:
+            return
+        line = json.dumps({'time': round(time.time(), 3), 'event': event, **fields}, default=str)
+        with self.lock:
+            self.file.write(line + '\n')
+
+    def count(self, counter, value=1):
+        with self.lock:
+            self.counters[counter] += value
+
+    def queue_depth(self):
+        # number of tasks waiting for a thread, relies on the work queue of concurrent.futures.ThreadPoolExecutor
+        work_queue = getattr(self.executor, '_work_queue', None)
+        return work_queue.qsize() if work_queue is not None else None
+
+    def run_finished(self, run_id, seconds, timings=None, failed=False):
+        transferred_bytes = timings.total('bytes') if timings is not None else 0
+        with self.lock:
+            self.runs_done += 1
+            self.runs_failed += failed
+            self.transferred_bytes += transferred_bytes
+        self.record('run', run_id=run_id, seconds=round(seconds, 3), bytes=transferred_bytes, failed=failed,
+                    queue_depth=self.queue_depth(), attributes=timings.as_dict() if timings is not None else None)
+        self.print_progress()
+
+    def print_progress(self, final=False):
+        if not self.progress:
+            return
+        now = time.monotonic()
+        with self.lock:
+            if not final and now - self.last_progress_time < PROGRESS_INTERVAL:
+                return
+            self.last_progress_time = now
+            elapsed = max(now - self.start_time, 1e-9)
+            runs_per_second = self.runs_done / elapsed
+            line = f'{self.runs_done}{f"/{self.total_runs}" if self.total_runs is not None else ""} runs'
+            if self.runs_failed:
+                line += f' ({self.runs_failed} failed)'
+            line += f', {runs_per_second:.2f} runs/s, {self.transferred_bytes / 1024 ** 2 / elapsed:.2f} MB/s'
+            queue_depth = self.queue_depth()
+            if queue_depth is not None:
+                line += f', {queue_depth} queued'
+            if self.total_runs is not None and runs_per_second > 0 and not final:
+                line += f', ETA {timedelta(seconds=round((self.total_runs - self.runs_done) / runs_per_second))}'
+            sys.stderr.write('\r' + line.ljust(100) + ('\n' if final else ''))
+            sys.stderr.flush()
+
+    def close(self):
+        self.record('summary', runs=self.runs_done, failed=self.runs_failed, bytes=self.transferred_bytes,
+                    seconds=round(time.monotonic() - self.start_time, 3), counters=dict(self.counters))
+        self.print_progress(final=True)
+        if self.file is not None:
+            self.file.close()
+
+
+class Timings:
+    # Time spent, attributes handled, bytes transferred and series points per attribute type of one run or project
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entries = {}
+
+    def add(self, kind, seconds, count=1, transferred_bytes=0, points=0):
+        with self.lock:
+            entry = self.entries.setdefault(kind, {'count': 0, 'seconds': 0.0, 'bytes': 0, 'points': 0})
+            entry['count'] += count
+            entry['seconds'] += seconds
+            entry['bytes'] += transferred_bytes
+            entry['points'] += points
+
+    @contextlib.contextmanager
+    def measure(self, kind, count=1):
+        # the block may set 'bytes' and 'points' of the yielded dict
+        measurement = {'bytes': 0, 'points': 0}
+        start = time.perf_counter()
+        try:
+            yield measurement
+        finally:
+            self.add(kind, time.perf_counter() - start, count, measurement['bytes'], measurement['points'])
+
+    def total(self, field):
+        with self.lock:
+            return sum(entry[field] for entry in self.entries.values())
+
+    def as_dict(self):
+        with self.lock:
+            return {kind: dict(entry, seconds=round(entry['seconds'], 3)) for kind, entry in self.entries.items()}
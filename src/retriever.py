@@ -8,6 +8,13 @@ from src.utils import RemoteKeys, is_read_only_field, is_value_in_class_attribut
 from neptune.types import File
 from datetime import datetime
 from neptune.management.exceptions import ProjectNameCollision
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from src.catalog import Catalog
+from src.metrics import Metrics, Timings
+from src.storage import blob_name, is_blob_reference, join_name, open_archive
+from fnmatch import fnmatchcase
+import tempfile
+import time
 
 # TODO make upload of runs same order as in original neptune workspace
 # TODO make upload of file series same order as in original neptune workspace
@@ -17,29 +24,113 @@ from neptune.management.exceptions import ProjectNameCollision
 # TODO setup test project
 
 
+class AttributeFilter:
+    # Selects the attributes of a run or project structure to restore. Paths must match one of the include globs, if
+    # given, and none of the exclude globs, e.g. metrics/* (* also matches /). Attributes of skipped_types (RemoteKeys)
+    # are not restored at all.
+    def __init__(self, include=(), exclude=(), skipped_types=()):
+        self.include = list(include or ())
+        self.exclude = list(exclude or ())
+        self.skipped_types = set(skipped_types)
+
+    def apply(self, remote_structure):
+        if not self.include and not self.exclude and not self.skipped_types:
+            return remote_structure
+        return {remote_key: {} if RemoteKeys(remote_key) in self.skipped_types else
+                {path: entry for path, entry in entries.items() if self.is_selected(path)}
+                for remote_key, entries in remote_structure.items()}
+
+    def is_selected(self, path):
+        return (not self.include or any(fnmatchcase(path, pattern) for pattern in self.include)) and \
+            not any(fnmatchcase(path, pattern) for pattern in self.exclude)
+
+
 class Retriever:
 
-    def __init__(self, source: Path, workspace: str, project_name: str, alternative_sys_namespace=None):
+    def __init__(self, source: Path, workspace: str, project_name: str, alternative_sys_namespace=None,
+                 series_chunk_size=None, metrics_file=None, progress=False, attribute_filter=None):
+        # source is either an archive directory or a single-file (.zip) archive, compressed structures and series are
+        # decompressed while they are read. If series_chunk_size is given, series are read and uploaded in chunks of
+        # that many points. Timings per run and attribute type are written to metrics_file, progress is printed to
+        # stderr. Only attributes selected by attribute_filter are restored, their data is the only data read.
         self.source = source
+        self.storage = open_archive(source)
+        self.series_chunk_size = series_chunk_size
         self.workspace = self.get_workspace(workspace)
         self.project_name = self.get_project_name(project_name)
         self.project_id = self.workspace + '/' + self.project_name
         self.alternative_sys_namespace = alternative_sys_namespace
+        self.metrics_file = metrics_file
+        self.progress = progress
+        self.attribute_filter = attribute_filter or AttributeFilter()
 
-    def restore(self, create_project=True, visibility=None, key=None):
+    def restore(self, create_project=True, visibility=None, key=None, num_workers=1, run_ids=None,
+                upload_project=True):
+        # Returns the ids of archived runs that could not be restored. Every worker holds at most one open async run,
+        # so num_workers also bounds the number of local neptune operation queues on disk.
         if create_project:
             self.create_project(workspace=self.workspace, name=self.project_name, key=key, visibility=visibility)
-        project_structure, project = self.setup_project_upload()
-        self.traverse_local_structure(project_structure, project, self.source)
-        # TODO implement multiprocessing
-        for source_run in self.source.iterdir():
-            if source_run.is_dir():
-                run_structure, run = self.setup_run_upload(source_run)
-                self.traverse_local_structure(run_structure, run, source_run)
-                run.stop()
+        if upload_project:
+            project_structure, project = self.setup_project_upload()
+            with tempfile.TemporaryDirectory() as temp_dir:
+                self.traverse_local_structure(project_structure, project, '', Path(temp_dir))
+                project.stop()  # files are read from temp_dir until they are synced
+        source_runs = [run_id for run_id in self.storage.list_runs() if run_ids is None or run_id in run_ids]
+        failed_runs = []
+        with ThreadPoolExecutor(num_workers) as executor:
+            metrics = Metrics(self.metrics_file, self.progress, total_runs=len(source_runs), executor=executor)
+            futures = {executor.submit(self.restore_run, source_run, metrics): source_run for source_run in source_runs}
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as exception:
+                    print(f'Restoring run {futures[future]} failed: {exception}')
+                    failed_runs.append(futures[future])
+        metrics.close()
+        return sorted(failed_runs)
+
+    def restore_run(self, source_run, metrics=None):
+        metrics = metrics or Metrics()
+        timings = Timings()
+        start = time.perf_counter()
+        failed = True
+        try:
+            run_structure, run = self.setup_run_upload(source_run)
+            try:
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    try:
+                        self.traverse_local_structure(run_structure, run, source_run, Path(temp_dir), timings)
+                    finally:
+                        with timings.measure('sync'):
+                            run.stop()  # files are read from temp_dir until they are synced
+            except Exception:
+                # a retry restores the run again as a new run, so the partially restored one is moved to the trash
+                self.trash_run(source_run, run)
+                raise
+            failed = False
+        finally:
+            metrics.run_finished(source_run, time.perf_counter() - start, timings, failed=failed)
+
+    def trash_run(self, source_run, run):
+        # called while the error of the restore propagates, so errors of trashing are only reported
+        try:
+            run_id = run._sys_id  # known since init_run, sys/id can not be fetched from a stopped run
+            management.trash_objects(project=self.project_id, ids=run_id)
+            print(f'Moved {run_id}, the partially restored run {source_run}, to the trash')
+        except Exception as exception:
+            print(f'Moving the partially restored run {source_run} to the trash failed: {exception}. Delete it before '
+                  f'restoring {source_run} again')
+
+    def find_runs(self, tags=(), conditions=()):
+        # ids of archived runs matching tags and conditions, see Catalog.query
+        catalog = Catalog.open(self.storage)
+        try:
+            return catalog.query(tags, conditions)
+        finally:
+            catalog.close()
 
     def create_project(self, workspace, name=None, key=None, visibility=None):
-        with (self.source / utils.PROJECT_STRUCTURE).open('r') as file:
+        with self.storage.open(utils.PROJECT_STRUCTURE) as file:
             project_info = json.load(file)
         if not name:
             name = project_info['atoms']['sys/name']
@@ -60,27 +151,48 @@ class Retriever:
             raise SystemExit("Exiting the program due to unresolved name conflict.")
 
     def setup_run_upload(self, source):
-        with (source / utils.RUN_STRUCTURE).open('r') as file:
+        with self.storage.open(join_name(source, utils.RUN_STRUCTURE)) as file:
             run_structure = json.load(file)
         run = neptune.init_run(project=self.project_id, mode='async', capture_stderr=False, capture_traceback=False,
                                capture_stdout=False, capture_hardware_metrics=False, source_files=[], git_ref=False)
         return run_structure, run
 
     def setup_project_upload(self):
-        with (self.source / utils.PROJECT_STRUCTURE).open('r') as file:
+        with self.storage.open(utils.PROJECT_STRUCTURE) as file:
             project_structure = json.load(file)
         project = neptune.init_project(self.project_id)
         return project_structure, project
 
-    def traverse_local_structure(self, remote_structure, neptune_object, source):
-        self.traverse_atoms(remote_structure[RemoteKeys.ATOMS.value], neptune_object)
-        self.traverse_timestamps(remote_structure[RemoteKeys.TIME_STAMPS.value], neptune_object)
-        self.traverse_float_series(remote_structure[RemoteKeys.FLOAT_SERIES.value], neptune_object, source)
-        self.traverse_string_series(remote_structure[RemoteKeys.STRING_SERIES.value], neptune_object, source)
-        self.traverse_files(remote_structure[RemoteKeys.FILES.value], neptune_object, source)
-        self.traverse_string_sets(remote_structure[RemoteKeys.STRING_SETS.value], neptune_object)
-        self.traverse_file_sets(remote_structure[RemoteKeys.FILE_SETS.value], neptune_object, source)
-        self.traverse_file_series(remote_structure[RemoteKeys.FILE_SERIES.value], neptune_object, source)
+    def traverse_local_structure(self, remote_structure, neptune_object, source, temp_dir, timings=None):
+        # source is the name of the object's directory in the archive, files of zip archives are extracted to temp_dir.
+        # The series traversals return the number of points, the file traversals the number of bytes uploaded.
+        timings = timings or Timings()
+        remote_structure = self.attribute_filter.apply(remote_structure)
+
+        def measure(remote_key):
+            return timings.measure(remote_key.value, count=len(remote_structure[remote_key.value]))
+
+        with measure(RemoteKeys.ATOMS):
+            self.traverse_atoms(remote_structure[RemoteKeys.ATOMS.value], neptune_object)
+        with measure(RemoteKeys.TIME_STAMPS):
+            self.traverse_timestamps(remote_structure[RemoteKeys.TIME_STAMPS.value], neptune_object)
+        with measure(RemoteKeys.FLOAT_SERIES) as measurement:
+            measurement['points'] = self.traverse_float_series(remote_structure[RemoteKeys.FLOAT_SERIES.value],
+                                                               neptune_object, source)
+        with measure(RemoteKeys.STRING_SERIES) as measurement:
+            measurement['points'] = self.traverse_string_series(remote_structure[RemoteKeys.STRING_SERIES.value],
+                                                                neptune_object, source)
+        with measure(RemoteKeys.FILES) as measurement:
+            measurement['bytes'] = self.traverse_files(remote_structure[RemoteKeys.FILES.value], neptune_object,
+                                                       source, temp_dir)
+        with measure(RemoteKeys.STRING_SETS):
+            self.traverse_string_sets(remote_structure[RemoteKeys.STRING_SETS.value], neptune_object)
+        with measure(RemoteKeys.FILE_SETS) as measurement:
+            measurement['bytes'] = self.traverse_file_sets(remote_structure[RemoteKeys.FILE_SETS.value],
+                                                           neptune_object, source, temp_dir)
+        with measure(RemoteKeys.FILE_SERIES) as measurement:
+            measurement['bytes'] = self.traverse_file_series(remote_structure[RemoteKeys.FILE_SERIES.value],
+                                                             neptune_object, source, temp_dir)
 
     def traverse_atoms(self, atoms, neptune_object):
         for key in atoms.keys():
@@ -103,43 +215,108 @@ class Retriever:
             if len(string_set) > 0:
                 neptune_object[key].add(string_set)
 
-    @staticmethod
-    def traverse_files(files, neptune_object, source):
+    def traverse_files(self, files, neptune_object, source, temp_dir):
+        uploaded_bytes = 0
         for key in files.keys():
-            neptune_object[key].upload(str(source / files[key]))
+            file_path = self.get_local_path(files[key], source, temp_dir)
+            neptune_object[key].upload(str(file_path))
+            uploaded_bytes += file_path.stat().st_size
+        return uploaded_bytes
 
-    @staticmethod
-    def traverse_file_sets(file_sets, neptune_object, source):
+    def traverse_file_sets(self, file_sets, neptune_object, source, temp_dir):
+        uploaded_bytes = 0
         for key in file_sets.keys():
-            neptune_object[key].upload_files(str(source / file_sets[key]))
+            file_set_path = self.get_local_directory(file_sets[key], source, temp_dir / key)
+            if file_set_path.exists():  # empty file sets have no members in the archive
+                neptune_object[key].upload_files(str(file_set_path))
+                uploaded_bytes += sum(file.stat().st_size for file in file_set_path.rglob('*') if file.is_file())
+        return uploaded_bytes
 
-    @staticmethod
-    def traverse_file_series(file_series, neptune_object, source):
+    def traverse_file_series(self, file_series, neptune_object, source, temp_dir):
+        uploaded_bytes = 0
         for key in file_series.keys():
-            for file in (source / file_series[key]).iterdir():
+            file_series_path = self.get_local_directory(file_series[key], source, temp_dir / key)
+            if not file_series_path.exists():  # empty file series have no files in the archive
+                continue
+            for file in sorted(file_series_path.iterdir()):
                 if file.is_file():
                     neptune_object[key].append(File(str(file)))
+                    uploaded_bytes += file.stat().st_size
+        return uploaded_bytes
 
-    @staticmethod
-    def traverse_string_series(series, neptune_object, source):
+    def get_local_path(self, file_entry, source, temp_dir):
+        # file entries are blob references or, in archives of older versions, names of files in the object's directory
+        if is_blob_reference(file_entry):
+            return self.storage.local_path(blob_name(file_entry), temp_dir)
+        return self.storage.local_path(join_name(source, file_entry), temp_dir)
+
+    def get_local_directory(self, directory_entry, source, target_dir):
+        # directory entries map member names to blob references or, in archives of older versions, name a directory
+        if isinstance(directory_entry, str):
+            return self.storage.local_path(join_name(source, directory_entry), target_dir)
+        for member_name, reference in directory_entry.items():
+            (target_dir / member_name).parent.mkdir(parents=True, exist_ok=True)
+            self.storage.copy_to(blob_name(reference), target_dir / member_name)
+        return target_dir
+
+    def traverse_string_series(self, series, neptune_object, source):
+        points = 0
         for key in series.keys():
             if not series[key] is None:  # see comment on fetch_series in archiver.py
-                series_df = pd.read_csv(filepath_or_buffer=source / series[key], na_filter=False)
-                neptune_object[key].extend(values=series_df['value'].tolist(), steps=series_df['step'].tolist(),
-                                           timestamps=series_df['timestamp'].tolist())
+                for series_df in self.read_series(join_name(source, series[key]), key, na_filter=False):
+                    neptune_object[key].extend(values=series_df['value'].tolist(), steps=series_df['step'].tolist(),
+                                               timestamps=series_df['timestamp'].tolist())
+                    points += len(series_df)
+        return points
 
-    @staticmethod
-    def traverse_float_series(series, neptune_object, source):
+    def traverse_float_series(self, series, neptune_object, source):
+        points = 0
         for key in series.keys():
             if not series[key] is None:  # see comment on fetch_series in archiver.py
-                series_df = pd.read_csv(filepath_or_buffer=source / series[key])
-                neptune_object[key].extend(values=series_df['value'].tolist(), steps=series_df['step'].tolist(),
-                                           timestamps=series_df['timestamp'].tolist())
+                for series_df in self.read_series(join_name(source, series[key]), key):
+                    neptune_object[key].extend(values=series_df['value'].tolist(), steps=series_df['step'].tolist(),
+                                               timestamps=series_df['timestamp'].tolist())
+                    points += len(series_df)
+        return points
+
+    def read_series(self, name, key, **csv_kwargs):
+        # yields the series as one dataframe, or in dataframes of at most series_chunk_size rows
+        with self.storage.open(name, mode='rb') as series_file:
+            if name.endswith('.parquet'):  # parquet files hold all series of a type, keyed by the attribute path
+                yield from self.read_parquet_series(series_file, key, self.series_chunk_size)
+            elif self.series_chunk_size:
+                with pd.read_csv(filepath_or_buffer=series_file, chunksize=self.series_chunk_size,
+                                 **csv_kwargs) as reader:
+                    yield from reader
+            else:
+                yield pd.read_csv(filepath_or_buffer=series_file, **csv_kwargs)
+
+    @staticmethod
+    def read_parquet_series(series_file, key, chunk_size=None):
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(series_file)
+        path_column = parquet_file.schema_arrow.get_field_index('path')
+        row_groups = []
+        for row_group in range(parquet_file.num_row_groups):
+            statistics = parquet_file.metadata.row_group(row_group).column(path_column).statistics
+            if statistics is None or not statistics.has_min_max or statistics.min <= key <= statistics.max:
+                row_groups.append(row_group)
+        if not row_groups:
+            return
+        if not chunk_size:
+            series_df = parquet_file.read_row_groups(row_groups).to_pandas()
+            yield series_df.loc[series_df['path'] == key, ['step', 'value', 'timestamp']]
+            return
+        for record_batch in parquet_file.iter_batches(batch_size=chunk_size, row_groups=row_groups):
+            series_df = record_batch.to_pandas()
+            series_df = series_df.loc[series_df['path'] == key, ['step', 'value', 'timestamp']]
+            if len(series_df) > 0:
+                yield series_df
 
     def get_project_name(self, project_name):
         if project_name is None:
             print('No project-name argument given. Fetching project-name argument from archive.')
-            with (self.source / utils.PROJECT_STRUCTURE).open('r') as file:
+            with self.storage.open(utils.PROJECT_STRUCTURE) as file:
                 project_structure = json.load(file)
             project_name = project_structure['atoms']['sys/name']
             print(f'Using {project_name} as project name.')
@@ -148,7 +325,7 @@ class Retriever:
     def get_workspace(self, workspace):
         if workspace is None:
             print('No workspace argument given. Fetching workspace argument from archive.')
-            with (self.source / utils.ARCHIVE_INFO).open('r') as file:
+            with self.storage.open(utils.ARCHIVE_INFO) as file:
                 archive_info = json.load(file)
             workspace = archive_info['workspace']
             print(f'Using {workspace} as workspace.')
@@ -0,0 +1,127 @@
+import logging
+import random
+import threading
+import time
+import requests
+from neptune.exceptions import ClientHttpError, InternalServerError, NeptuneConnectionLostException
+
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+THROTTLED_STATUS_CODE = 429
+LATENCY_SMOOTHING = 0.2  # weight of a new latency in the moving average of its request kind
+DECREASE_COOLDOWN = 1.0  # minimum seconds between two decreases of the concurrency limit
+BASELINE_DRIFT = 1.01  # growth of the latency baseline per request, such that it follows a permanently slower backend
+
+
+def is_throttled(exception):
+    return getattr(exception, 'status', None) == THROTTLED_STATUS_CODE or \
+        type(exception).__name__ == 'HTTPTooManyRequests' or \
+        (isinstance(exception, NeptuneConnectionLostException) and is_throttled(exception.cause))
+
+
+def is_transient(exception):
+    # errors worth retrying: throttling, timeouts, lost connections and server errors. neptune retries most of them
+    # internally for NEPTUNE_RETRIES_TIMEOUT seconds before raising NeptuneConnectionLostException.
+    if isinstance(exception, ClientHttpError):
+        return exception.status in TRANSIENT_STATUS_CODES
+    return is_throttled(exception) or isinstance(exception, (
+        NeptuneConnectionLostException, InternalServerError, requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout, ConnectionError, TimeoutError))
+
+
+class RequestScheduler:
+    # Runs requests to the neptune backend with an adaptive limit on the number of concurrent requests and retries
+    # transient failures with exponential backoff and full jitter. The limit follows AIMD: it grows by one after a
+    # limit's worth of requests succeeded and is halved when a request fails transiently or takes latency_tolerance
+    # times longer than the fastest moving average of its kind. neptune waits out 429 responses itself, so throttling
+    # mostly shows as latency. Requests without a kind, e.g. file downloads whose latency depends on their size, only
+    # count their outcome. With max_concurrency None, requests are not limited.
+    def __init__(self, max_concurrency=None, retries=3, base_delay=1.0, max_delay=60.0, adaptive=True,
+                 latency_tolerance=3.0, metrics=None):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.adaptive = adaptive and max_concurrency is not None
+        self.latency_tolerance = latency_tolerance
+        self.metrics = metrics
+        self.condition = threading.Condition()
+        self.active = 0
+        self.successes = 0
+        self.last_decrease_time = 0
+        self.latency_averages = {}
+        self.latency_baselines = {}
+
+    def call(self, kind, function, *args, **kwargs):
+        attempt = 0
+        while True:
+            self.acquire()
+            start = time.monotonic()
+            try:
+                result = function(*args, **kwargs)
+            except Exception as exception:
+                self.release(kind, time.monotonic() - start, transient_failure=is_transient(exception))
+                if not is_transient(exception) or attempt >= self.retries:
+                    raise
+                delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                self.count('retries')
+                if is_throttled(exception):
+                    self.count('throttled')
+                logging.warning(f'{kind or "request"} failed transiently ({type(exception).__name__}), retry '
+                                f'{attempt + 1}/{self.retries} in {delay:.1f}s: {exception}')
+                time.sleep(delay)
+                attempt += 1
+            else:
+                self.release(kind, time.monotonic() - start)
+                return result
+
+    def acquire(self):
+        if self.max_concurrency is None:
+            return
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active += 1
+
+    def release(self, kind, latency, transient_failure=False):
+        if self.max_concurrency is None:
+            return
+        with self.condition:
+            self.active -= 1
+            if self.adaptive:
+                if transient_failure or self.is_slow(kind, latency):
+                    self.decrease()
+                else:
+                    self.successes += 1
+                    if self.successes >= self.limit and self.limit < self.max_concurrency:
+                        self.set_limit(self.limit + 1)
+            self.condition.notify_all()
+
+    def is_slow(self, kind, latency):
+        if kind is None:
+            return False
+        average = self.latency_averages.get(kind, latency)
+        average += LATENCY_SMOOTHING * (latency - average)
+        self.latency_averages[kind] = average
+        baseline = min(self.latency_baselines.get(kind, average) * BASELINE_DRIFT, average)
+        self.latency_baselines[kind] = baseline
+        return average > self.latency_tolerance * baseline
+
+    def decrease(self):
+        now = time.monotonic()
+        if now - self.last_decrease_time < DECREASE_COOLDOWN:
+            return
+        self.last_decrease_time = now
+        self.set_limit(max(1, self.limit // 2))
+
+    def set_limit(self, limit):
+        if limit != self.limit:
+            logging.info(f'Concurrency limit {self.limit} -> {limit}')
+            if self.metrics is not None:
+                self.metrics.record('concurrency', limit=limit)
+        self.limit = limit
+        self.successes = 0
+
+    def count(self, counter):
+        if self.metrics is not None:
+            self.metrics.count(counter)
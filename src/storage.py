@@ -0,0 +1,428 @@
+import hashlib
+import io
+import json
+import mmap
+import os
+import posixpath
+import shutil
+import struct
+import tempfile
+import threading
+import time
+import zipfile
+from collections import defaultdict
+from pathlib import Path
+import src.utils as utils
+
+ZIP_SUFFIX = '.zip'
+SPOOL_MAX_SIZE = 16 * 1024 ** 2  # members up to this size are spooled in memory before they are added to a zip
+HASH_CHUNK_SIZE = 1024 ** 2
+BLOBS_DIR = 'blobs'
+BLOB_REFERENCE_PREFIX = 'sha256:'
+COMPRESSED_SUFFIX = '.zst'  # members with this suffix are zstd compressed, see compress_stream
+COMPRESSION_LEVEL = 3
+UNCHECKED_MEMBERS = {utils.CHECKSUMS, utils.ARCHIVING_LOG}  # the log is still written to after the checksums
+
+
+def join_name(*parts):
+    # names of archive members are relative posix paths, e.g. <run_id>/run_structure.json
+    return '/'.join(part for part in parts if part)
+
+
+def sanitize_name(name):
+    # returns None for names that would end up outside of the directory they are extracted to
+    name = posixpath.normpath(name).lstrip('/')
+    if name == '.' or name == '..' or name.startswith('../'):
+        return None
+    return name
+
+
+def is_blob_reference(value):
+    return isinstance(value, str) and value.startswith(BLOB_REFERENCE_PREFIX)
+
+
+def blob_name(reference):
+    # blobs are shared by all objects of an archive and named by the sha256 of their content
+    digest = reference[len(BLOB_REFERENCE_PREFIX):]
+    return join_name(BLOBS_DIR, digest[:2], digest)
+
+
+def iter_blob_references(structure):
+    # yields the blob references of a structure: a file is a reference, file sets and file series map names to them
+    for remote_key in (utils.RemoteKeys.FILES, utils.RemoteKeys.FILE_SETS, utils.RemoteKeys.FILE_SERIES):
+        for value in structure.get(remote_key.value, {}).values():
+            if is_blob_reference(value):
+                yield value
+            elif isinstance(value, dict):
+                yield from (reference for reference in value.values() if is_blob_reference(reference))
+
+
+def hash_file(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(HASH_CHUNK_SIZE), b''):
+            sha256.update(chunk)
+    return BLOB_REFERENCE_PREFIX + sha256.hexdigest()
+
+
+def compress_stream(handle):
+    # Compresses everything written to the returned file object into handle, on all cores for large members. Closing
+    # it closes handle.
+    import zstandard
+    return zstandard.ZstdCompressor(level=COMPRESSION_LEVEL, threads=-1).stream_writer(handle)
+
+
+def decompress_stream(handle):
+    # members may consist of several frames, e.g. logs of incremental archiving
+    import zstandard
+    return zstandard.ZstdDecompressor().stream_reader(handle, read_across_frames=True)
+
+
+def open_archive(path: Path, mode='r', exist_ok=False):
+    if path.suffix == ZIP_SUFFIX:
+        return ZipStorage(path, mode)
+    return DirectoryStorage(path, mode, exist_ok)
+
+
+class ArchiveStorage:
+    # Common bookkeeping of the storages: the sha256 of every member written is collected and stored in the checksum
+    # manifest (sha256sum format) when the storage is closed.
+    def __init__(self, mode):
+        self.mode = mode
+        self.checksums = {}
+        self.checksum_lock = threading.Lock()
+        self.staged_names = set()
+
+    def record_checksum(self, name, digest):
+        with self.checksum_lock:
+            self.checksums[name] = digest
+
+    def forget_checksums(self, name):
+        with self.checksum_lock:
+            self.checksums = {member_name: digest for member_name, digest in self.checksums.items()
+                              if member_name != name and not member_name.startswith(name + '/')}
+
+    def read_checksums(self):
+        # returns {member name: sha256 hex digest}
+        checksums = {}
+        if self.exists(utils.CHECKSUMS):
+            with self.open(utils.CHECKSUMS) as checksum_file:
+                for line in checksum_file:
+                    if line.strip():
+                        digest, name = line.rstrip('\n').split('  ', 1)
+                        checksums[name] = digest
+        return checksums
+
+    def write_checksums(self, path):
+        for name in self.staged_names - UNCHECKED_MEMBERS:
+            if self.staging_path(name).exists():
+                self.record_checksum(name, hash_file(self.staging_path(name))[len(BLOB_REFERENCE_PREFIX):])
+        with open(path, 'w', encoding='utf-8') as checksum_file:
+            checksum_file.writelines(f'{digest}  {name}\n' for name, digest in sorted(self.checksums.items()))
+
+    def list_unreferenced_blobs(self):
+        # blobs that neither the project structure nor a run structure refers to, e.g. files of the version of a run
+        # that was replaced when incremental archiving archived the run again
+        referenced_blobs = set()
+        structures = [utils.PROJECT_STRUCTURE] + [join_name(run_id, utils.RUN_STRUCTURE) for run_id in self.list_runs()]
+        for name in structures:
+            if self.exists(self.resolve(name)):
+                with self.open(name) as file:
+                    referenced_blobs.update(blob_name(reference) for reference in iter_blob_references(json.load(file)))
+        return [name for name in self.list_members()
+                if name.startswith(BLOBS_DIR + '/') and name not in referenced_blobs]
+
+    def open(self, name, mode='r'):
+        # members with the compressed suffix are compressed when written and decompressed when read, the checksum is
+        # taken of the compressed data, like it is stored
+        if 'r' in mode:
+            name = self.resolve(name)
+            handle = self.open_raw(name)
+            if name.endswith(COMPRESSED_SUFFIX):
+                handle = decompress_stream(handle)
+        else:
+            # the member written with the other compression setting, e.g. by an earlier incremental archiving, would
+            # shadow the new one for readers, see resolve
+            variant = name[:-len(COMPRESSED_SUFFIX)] if name.endswith(COMPRESSED_SUFFIX) else name + COMPRESSED_SUFFIX
+            if self.exists(variant):
+                self.remove(variant)
+            handle = self.open_raw(name, mode='wb')
+            if name.endswith(COMPRESSED_SUFFIX):
+                handle = compress_stream(handle)
+        return handle if 'b' in mode else io.TextIOWrapper(handle, encoding='utf-8')
+
+    def resolve(self, name):
+        # members written with compression have the compressed suffix, e.g. run_structure.json.zst. Readers ask for
+        # the plain name and get the member that exists.
+        if not name.endswith(COMPRESSED_SUFFIX) and not self.exists(name) and self.exists(name + COMPRESSED_SUFFIX):
+            return name + COMPRESSED_SUFFIX
+        return name
+
+    def compress_staged(self, name):
+        # replaces a staged member by its compressed version. An existing compressed version, e.g. the log of an
+        # earlier incremental archiving, is continued with a new frame.
+        path = self.staging_path(name)
+        compressed_path = self.staging_path(name + COMPRESSED_SUFFIX)
+        with path.open('rb') as source, compress_stream(compressed_path.open('ab')) as target:
+            shutil.copyfileobj(source, target)
+        path.unlink()
+        self.staged_names.discard(name)
+
+
+class DirectoryStorage(ArchiveStorage):
+    # Archive stored as a plain directory tree
+    def __init__(self, root: Path, mode='r', exist_ok=False):
+        super().__init__(mode)
+        self.root = root
+        if mode == 'w':
+            self.root.mkdir(exist_ok=exist_ok)
+            self.checksums = self.read_checksums()  # incremental archiving keeps the checksums of earlier runs
+
+    def open_raw(self, name, mode='rb'):
+        # binary file object of a member as stored, written members are checksummed
+        path = self.root / name
+        if 'r' in mode:
+            return path.open('rb')
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return ChecksumWriter(path.open('wb'), self, name)
+
+    def temp_dir(self):
+        # temporary directory on the archive's file system, such that blobs are moved into the archive, not copied
+        return tempfile.TemporaryDirectory(dir=self.root, prefix='.tmp-')
+
+    def add_blob(self, name, path):
+        # moves the file at path into the archive, unless a blob with the same name (and thus content) exists
+        self.record_checksum(name, posixpath.basename(name))
+        target = self.root / name
+        if target.exists():
+            return
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(path, target)
+
+    def staging_path(self, name):
+        # local path for files written by other libraries (logs, tables), which are part of the archive after close
+        self.staged_names.add(name)
+        return self.root / name
+
+    def local_path(self, name, temp_dir):
+        return self.root / name
+
+    def copy_to(self, name, target):
+        try:
+            os.link(self.root / name, target)
+        except OSError:
+            shutil.copyfile(self.root / name, target)
+
+    def hash_member(self, name):
+        with (self.root / name).open('rb') as file:
+            if os.fstat(file.fileno()).st_size == 0:
+                return hashlib.sha256().hexdigest()
+            with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as file_map:
+                return hashlib.sha256(file_map).hexdigest()
+
+    def exists(self, name):
+        return (self.root / name).exists()
+
+    def size(self, name):
+        return (self.root / name).stat().st_size
+
+    def remove(self, name):
+        self.forget_checksums(name)
+        if (self.root / name).is_dir():
+            shutil.rmtree(self.root / name)
+        else:
+            (self.root / name).unlink()
+
+    def list_members(self):
+        return sorted(path.relative_to(self.root).as_posix() for path in self.root.rglob('*')
+                      if path.is_file() and not path.relative_to(self.root).parts[0].startswith('.tmp-'))
+
+    def list_runs(self):
+        return sorted(path.name for path in self.root.iterdir() if (path / utils.RUN_STRUCTURE).is_file() or
+                      (path / (utils.RUN_STRUCTURE + COMPRESSED_SUFFIX)).is_file())
+
+    def close(self):
+        if self.mode == 'w':
+            self.write_checksums(self.root / utils.CHECKSUMS)
+
+
+class ZipStorage(ArchiveStorage):
+    # Archive stored in a single zip file. The central directory appended to the zip serves as index, so members are
+    # looked up in O(1) after opening. Writes are serialized by a lock, members are spooled to temporary files first
+    # such that writers only hold the lock while copying into the zip.
+    def __init__(self, path: Path, mode='r'):
+        super().__init__(mode)
+        self.path = path
+        self.lock = threading.Lock()
+        self.zip_file = zipfile.ZipFile(path, 'x' if mode == 'w' else 'r', allowZip64=True)
+        self.staging_dir = tempfile.TemporaryDirectory() if mode == 'w' else None
+        self.directory_index = None
+        self.zip_map = None
+
+    def open_raw(self, name, mode='rb'):
+        if 'r' in mode:
+            return self.zip_file.open(name)
+        return ChecksumWriter(ZipMemberWriter(self, name), self, name)
+
+    def temp_dir(self):
+        return tempfile.TemporaryDirectory()
+
+    def add_blob(self, name, path):
+        self.record_checksum(name, posixpath.basename(name))
+        with self.lock:
+            if not self.is_member(name):
+                self.zip_file.write(path, name)
+
+    def staging_path(self, name):
+        self.staged_names.add(name)
+        path = Path(self.staging_dir.name) / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        return path
+
+    def local_path(self, name, temp_dir):
+        # extracts a member, or all members below a directory name, to temp_dir
+        if self.is_member(name):
+            return Path(self.zip_file.extract(name, temp_dir))
+        for member_name in self.get_directory_index().get(name, []):
+            self.zip_file.extract(member_name, temp_dir)
+        return Path(temp_dir) / name
+
+    def copy_to(self, name, target):
+        with self.zip_file.open(name) as source, open(target, 'wb') as target_file:
+            shutil.copyfileobj(source, target_file)
+
+    def hash_member(self, name):
+        # uncompressed members are hashed straight from a memory map of the zip, others are decompressed
+        member_info = self.zip_file.getinfo(name)
+        if member_info.compress_type != zipfile.ZIP_STORED or member_info.flag_bits & 0x1:
+            sha256 = hashlib.sha256()
+            with self.zip_file.open(name) as member:
+                for chunk in iter(lambda: member.read(HASH_CHUNK_SIZE), b''):
+                    sha256.update(chunk)
+            return sha256.hexdigest()
+        zip_map = self.get_zip_map()
+        name_length, extra_length = struct.unpack('<HH', zip_map[member_info.header_offset + 26:
+                                                                 member_info.header_offset + 30])
+        data_offset = member_info.header_offset + 30 + name_length + extra_length
+        with memoryview(zip_map) as zip_view:
+            return hashlib.sha256(zip_view[data_offset:data_offset + member_info.file_size]).hexdigest()
+
+    def get_zip_map(self):
+        with self.lock:
+            if self.zip_map is None:
+                with self.path.open('rb') as file:
+                    self.zip_map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        return self.zip_map
+
+    def exists(self, name):
+        return self.is_member(name) or name in self.get_directory_index()
+
+    def size(self, name):
+        return self.zip_file.getinfo(name).file_size
+
+    def is_member(self, name):
+        try:
+            self.zip_file.getinfo(name)
+        except KeyError:
+            return False
+        return True
+
+    def get_directory_index(self):
+        # maps every directory to the names of all members below it
+        if self.directory_index is None:
+            directory_index = defaultdict(list)
+            for member_name in self.zip_file.namelist():
+                parts = member_name.split('/')
+                for depth in range(1, len(parts)):
+                    directory_index['/'.join(parts[:depth])].append(member_name)
+            self.directory_index = directory_index
+        return self.directory_index
+
+    def list_members(self):
+        return [member_info.filename for member_info in self.zip_file.infolist() if not member_info.is_dir()]
+
+    def list_runs(self):
+        return sorted(posixpath.dirname(member_name) for member_name in self.zip_file.namelist()
+                      if member_name.count('/') == 1 and
+                      posixpath.basename(member_name) in (utils.RUN_STRUCTURE, utils.RUN_STRUCTURE + COMPRESSED_SUFFIX))
+
+    def add_path(self, name, path):
+        with self.lock:
+            if path.is_dir():
+                for file in sorted(path.rglob('*')):
+                    if file.is_file():
+                        self.zip_file.write(file, join_name(name, file.relative_to(path).as_posix()))
+            else:
+                self.zip_file.write(path, name)
+
+    def add_stream(self, name, stream, size):
+        member_info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+        member_info.file_size = size  # lets zipfile decide whether zip64 extensions are needed
+        member_info.compress_type = self.zip_file.compression
+        member_info.external_attr = 0o600 << 16
+        with self.lock, self.zip_file.open(member_info, 'w') as member:
+            shutil.copyfileobj(stream, member)
+
+    def close(self):
+        if self.mode == 'w':
+            self.write_checksums(self.staging_path(utils.CHECKSUMS))
+            self.add_path('', Path(self.staging_dir.name))
+            self.staging_dir.cleanup()
+        if self.zip_map is not None:
+            self.zip_map.close()
+        self.zip_file.close()
+
+
+class ZipMemberWriter(io.BufferedIOBase):
+    # file object for writing a zip member, which is added to the zip when closed
+    def __init__(self, storage, name):
+        super().__init__()
+        self.storage = storage
+        self.member_name = name
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE)
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        return self.spool.write(data)
+
+    def tell(self):
+        return self.spool.tell()
+
+    def close(self):
+        if not self.closed:
+            size = self.spool.tell()
+            self.spool.seek(0)
+            self.storage.add_stream(self.member_name, self.spool, size)
+            self.spool.close()
+        super().close()
+
+
+class ChecksumWriter(io.BufferedIOBase):
+    # hashes everything written to a member and records the checksum when the member is closed
+    def __init__(self, handle, storage, name):
+        super().__init__()
+        self.handle = handle
+        self.storage = storage
+        self.member_name = name
+        self.sha256 = hashlib.sha256()
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self.sha256.update(data)
+        return self.handle.write(data)
+
+    def tell(self):
+        return self.handle.tell()
+
+    def flush(self):
+        self.handle.flush()
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self.handle.close()
+            self.storage.record_checksum(self.member_name, self.sha256.hexdigest())
@@ -1,5 +1,9 @@
 from enum import Enum
+import importlib
 import logging
+from pathlib import Path
+import pandas as pd
+from dateutil.tz import tzlocal
 
 
 class RemoteKeys(Enum):
@@ -13,16 +17,45 @@ class RemoteKeys(Enum):
     STRING_SETS = 'string_sets'
 
 
+class SeriesFormats:
+    CSV = 'csv'
+    PARQUET = 'parquet'
+
+
+class ContainerFormats:
+    ZIP = 'zip'
+
+
+class CompressionFormats:
+    ZSTD = 'zstd'
+
+
+PARQUET_SERIES_FILES = {RemoteKeys.FLOAT_SERIES: 'float_series.parquet',
+                        RemoteKeys.STRING_SERIES: 'string_series.parquet'}
+
 PROJECT_STRUCTURE = 'project_structure.json'
 ARCHIVE_INFO = '.archive_info'
 RUN_STRUCTURE = 'run_structure.json'
 RUNS_TABLE = 'runs_table.csv'
+ARCHIVE_MANIFEST = 'archive_manifest.jsonl'
+CATALOG = 'catalog.sqlite'
+CHECKSUMS = 'checksums.sha256'
+ARCHIVING_LOG = 'archiving.log'
 
 # TODO check if this is correct, project/run may be different
 NEPTUNE_READ_ONLY_FIELDS = {'sys/id', 'sys/monitoring_time', 'sys/owner', 'sys/running_time', 'sys/size', 'sys/trashed',
                             'sys/name', 'sys/visibility', 'sys/creation_time', 'sys/modification_time', 'sys/ping_time'}
 
 
+def require_module(module_name, option):
+    # optional dependencies are imported where they are used, options that need one check it up front instead of
+    # failing every run
+    try:
+        importlib.import_module(module_name)
+    except ImportError as exception:
+        raise ImportError(f'{option} requires {module_name}, install it with pip install {module_name}') from exception
+
+
 def configure_logging(log_filename):
     # Configure logging to write to a file
     logging.basicConfig(
@@ -33,6 +66,53 @@ def configure_logging(log_filename):
     logging.info("Logging is configured.")
 
 
+def stop_logging(log_filename):
+    # closes the handler configure_logging added, such that the log file can be moved or compressed
+    for handler in logging.root.handlers[:]:
+        if isinstance(handler, logging.FileHandler) and handler.baseFilename == str(Path(log_filename).absolute()):
+            logging.root.removeHandler(handler)
+            handler.close()
+
+
+def table_datetime_to_timestamp(value):
+    # datetimes of the runs table without time zone are UTC, the same rule pages the runs table by creation time
+    timestamp = pd.Timestamp(value)
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.tz_localize('UTC')
+    return timestamp.timestamp()
+
+
+def datetimes_to_timestamps(datetimes):
+    # vectorized version of datetimes.apply(lambda x: x.to_pydatetime().timestamp()) for the timestamp column of
+    # series fetch_values. neptune builds it with datetime.fromtimestamp, so naive values are local time, unlike those
+    # of the runs table. Values that are ambiguous in local time (DST changes) take the slow path.
+    localized = datetimes.dt.tz_localize(tzlocal(), ambiguous='NaT', nonexistent='NaT') \
+        if datetimes.dt.tz is None else datetimes
+    timestamps = ((localized - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(microseconds=1)) / 10 ** 6
+    unresolved = timestamps.isna()
+    if unresolved.any():
+        timestamps[unresolved] = datetimes[unresolved].apply(lambda x: x.to_pydatetime().timestamp())
+    return timestamps
+
+
+def concat_csv_files(paths, target_path, key=None):
+    # concatenates csv files with possibly different columns into one csv with the union of their columns. Values are
+    # copied as text and only one file is held in memory at a time. If key is given, only the first row of every value
+    # of the key column is kept.
+    columns = {}
+    seen_keys = set()
+    for path in paths:
+        columns.update(dict.fromkeys(pd.read_csv(path, nrows=0).columns))
+    with open(target_path, 'w', encoding='utf-8', newline='') as target_file:
+        for position, path in enumerate(paths):
+            csv_df = pd.read_csv(path, dtype=str, keep_default_na=False)
+            if key is not None and key in csv_df.columns:
+                csv_df = csv_df.loc[~csv_df[key].isin(seen_keys)].drop_duplicates(subset=key)
+                seen_keys.update(csv_df[key])
+            csv_df.reindex(columns=list(columns), fill_value='').to_csv(path_or_buf=target_file, index=False,
+                                                                        header=(position == 0))
+
+
 def is_read_only_field(field):
     return field in NEPTUNE_READ_ONLY_FIELDS
 
@@ -0,0 +1,174 @@
+import json
+import math
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import neptune
+import pandas as pd
+from neptune.attributes import FileSet, FloatSeries, GitRef, RunState, StringSeries
+import src.utils as utils
+from src.utils import RemoteKeys
+from src.catalog import Catalog
+from src.storage import UNCHECKED_MEMBERS, join_name, open_archive
+
+
+class Verifier:
+    # Checks an archive against the checksum manifest written while archiving and compares it with the live neptune
+    # project using metadata only (attribute paths, atom values, series lengths and last values, file set sizes).
+    # Both checks return a list of problems, an empty list means the archive is complete and intact.
+    def __init__(self, source: Path, num_workers=None):
+        self.storage = open_archive(source)
+        self.num_workers = num_workers or os.cpu_count()
+
+    def verify_checksums(self):
+        checksums = self.storage.read_checksums()
+        if not checksums:
+            return [f'Archive has no {utils.CHECKSUMS}, it was created by an older archiver version.']
+        # hashlib releases the GIL while hashing, so threads hash members on all cores
+        with ThreadPoolExecutor(self.num_workers) as executor:
+            problems = [problem for problem in executor.map(self.verify_member, checksums.items())
+                        if problem is not None]
+        unlisted_members = set(self.storage.list_members()) - set(checksums) - UNCHECKED_MEMBERS
+        problems.extend(f'{name} is not listed in {utils.CHECKSUMS}' for name in sorted(unlisted_members))
+        if not problems:  # references are read from the structures, which are only known to be intact now
+            problems.extend(f'{name} is not referenced by any structure'
+                            for name in self.storage.list_unreferenced_blobs())
+        return problems
+
+    def verify_member(self, checksum_entry):
+        name, digest = checksum_entry
+        try:
+            if self.storage.hash_member(name) != digest:
+                return f'{name} is corrupted, its checksum does not match'
+        except (FileNotFoundError, KeyError):
+            return f'{name} is missing'
+        return None
+
+    def compare_with_project(self, project_id, check_series_lengths=False):
+        # series lengths need one request per series, everything else is taken from the runs table and run structures
+        project = neptune.init_project(project=project_id, mode='read-only')
+        runs_table = project.fetch_runs_table().to_pandas().set_index('sys/id', drop=False)
+        project.stop()
+        archived_runs = set(self.storage.list_runs())
+        problems = [f'{run_id} is not archived' for run_id in sorted(set(runs_table.index) - archived_runs)]
+        problems.extend(f'{run_id} is not in the project' for run_id in sorted(archived_runs - set(runs_table.index)))
+        catalog = Catalog.open(self.storage) if self.storage.exists(utils.CATALOG) else None
+        if catalog is None:
+            problems.append(f'Archive has no {utils.CATALOG}, series and file sets are not compared.')
+
+        def compare_run(run_id):
+            return self.compare_run(run_id, project_id, runs_table.loc[run_id].to_dict(), catalog,
+                                    check_series_lengths)
+
+        try:
+            with ThreadPoolExecutor(self.num_workers) as executor:
+                for run_problems in executor.map(compare_run, sorted(archived_runs & set(runs_table.index))):
+                    problems.extend(run_problems)
+        finally:
+            if catalog is not None:
+                catalog.close()
+        return problems
+
+    def compare_run(self, run_id, project_id, table_row, catalog, check_series_lengths):
+        with self.storage.open(join_name(run_id, utils.RUN_STRUCTURE)) as file:
+            run_structure = json.load(file)
+        run = neptune.init_run(with_id=run_id, project=project_id, mode='read-only')
+        try:
+            live_attributes = dict(iter_attributes(run.get_structure()))
+            problems = self.compare_paths(run_id, run_structure, live_attributes)
+            problems.extend(self.compare_atoms(run_id, run_structure, table_row))
+            if catalog is not None:
+                problems.extend(self.compare_series(run_id, catalog, live_attributes, table_row,
+                                                    check_series_lengths))
+                problems.extend(self.compare_file_sets(run_id, catalog, live_attributes))
+        finally:
+            run.stop()
+        return problems
+
+    @staticmethod
+    def compare_paths(run_id, run_structure, live_attributes):
+        archived_paths = {path for entries in run_structure.values() for path in entries}
+        live_paths = {path for path, attribute in live_attributes.items()
+                      if not isinstance(attribute, (RunState, GitRef))}  # not archived, see NeptuneObjArchiver.fetch
+        return [f'{run_id}: {path} is missing in the archive' for path in sorted(live_paths - archived_paths)] + \
+            [f'{run_id}: {path} is not in the project' for path in sorted(archived_paths - live_paths)]
+
+    @staticmethod
+    def compare_atoms(run_id, run_structure, table_row):
+        problems = []
+        for path, value in run_structure[RemoteKeys.ATOMS.value].items():
+            table_value = table_row.get(path)
+            if table_value is not None and not pd.isna(table_value) and not values_match(value, table_value):
+                problems.append(f'{run_id}: {path} is {value} in the archive, {table_value} in the project')
+        for path, value in run_structure[RemoteKeys.TIME_STAMPS.value].items():
+            table_value = table_row.get(path)
+            if table_value is not None and not pd.isna(table_value) and \
+                    not math.isclose(value, utils.table_datetime_to_timestamp(table_value), abs_tol=1e-3):
+                problems.append(f'{run_id}: {path} is {value} in the archive, {table_value} in the project')
+        return problems
+
+    @staticmethod
+    def compare_series(run_id, catalog, live_attributes, table_row, check_series_lengths):
+        problems = []
+        archived_series = catalog.get_series(run_id)
+        for path, attribute in live_attributes.items():
+            if not isinstance(attribute, (FloatSeries, StringSeries)):
+                continue
+            points, _, last_value = archived_series.get(path, (0, None, None))
+            table_value = table_row.get(path)
+            if table_value is not None and not pd.isna(table_value) and not values_match(last_value, table_value):
+                problems.append(f'{run_id}: last value of {path} is {last_value} in the archive, '
+                                f'{table_value} in the project')
+            if check_series_lengths:
+                live_points = attribute._fetch_values_from_backend(0, 1).totalItemCount
+                if live_points != points:
+                    problems.append(f'{run_id}: {path} has {points} points in the archive, {live_points} in the '
+                                    f'project')
+        return problems
+
+    @staticmethod
+    def compare_file_sets(run_id, catalog, live_attributes):
+        problems = []
+        archived_members = {(path, member): size for path, member, size in
+                            catalog.get_attributes(run_id, RemoteKeys.FILE_SETS)}
+        for path, attribute in live_attributes.items():
+            if not isinstance(attribute, FileSet):
+                continue
+            for member, size in iter_file_set_files(attribute):
+                archived_size = archived_members.get((path, member))
+                if archived_size is None:
+                    problems.append(f'{run_id}: {path}/{member} is missing in the archive')
+                elif archived_size != size:
+                    problems.append(f'{run_id}: {path}/{member} has {archived_size} bytes in the archive, {size} '
+                                    f'in the project')
+        return problems
+
+
+def iter_attributes(neptune_structure, concatenated_key=''):
+    # yields (path, attribute) of a structure returned by get_structure
+    for key, value in neptune_structure.items():
+        if isinstance(value, dict):
+            yield from iter_attributes(value, join_name(concatenated_key, key))
+        else:
+            yield join_name(concatenated_key, key), value
+
+
+def iter_file_set_files(file_set, path=None):
+    # yields (member name, size) of all files in a file set
+    for entry in file_set.list_fileset_files(path=path):
+        entry_path = join_name(path, entry.name)
+        if entry.file_type == 'directory':
+            yield from iter_file_set_files(file_set, entry_path)
+        else:
+            yield entry_path, entry.size
+
+
+def values_match(archived_value, live_value):
+    if isinstance(archived_value, (bool, int, float)):
+        try:
+            live_value = float(live_value)
+        except (TypeError, ValueError):
+            return False
+        return math.isclose(float(archived_value), live_value, rel_tol=1e-9) or \
+            (math.isnan(archived_value) and math.isnan(live_value))
+    return str(archived_value) == str(live_value)
@@ -0,0 +1,159 @@
+import json
+import re
+import sys
+from unittest import mock
+import numpy as np
+import pandas as pd
+import pytest
+
+pytest.importorskip('neptune')
+
+from benchmarks.fake_neptune import FakeBackend, ProjectShape  # noqa: E402
+from src.archiver import Archiver, NeptuneObjArchiver, iter_runs_table, shard_of  # noqa: E402
+from src.retriever import Retriever  # noqa: E402
+from src.scheduler import RequestScheduler  # noqa: E402
+from src.storage import BLOBS_DIR, join_name  # noqa: E402
+from src.utils import RUN_STRUCTURE, RemoteKeys, SeriesFormats  # noqa: E402
+from src.verifier import Verifier  # noqa: E402
+
+
+def test_shards_partition_runs():
+    run_ids = [f'RUN-{number}' for number in range(1, 1001)]
+    shards = [[run_id for run_id in run_ids if shard_of(run_id, 4) == index] for index in range(4)]
+    assert sorted(run_id for shard in shards for run_id in shard) == sorted(run_ids)
+    assert all(len(shard) > 150 for shard in shards)  # crc32 spreads sequential ids over the shards
+
+
+def test_shard_of_is_stable():
+    # shard archives of one project are written by separate processes, so the assignment must not depend on the process
+    assert shard_of('RUN-1', 4) == shard_of('RUN-1', 4) == 0x73d26e39 % 4
+    assert shard_of('RUN-1', 1) == 0
+
+
+class FakeTable:
+    def __init__(self, table_df):
+        self.table_df = table_df
+
+    def to_pandas(self):
+        return self.table_df
+
+
+class FakeProject:
+    # runs table of runs created at the given times, neptune returns them without time zone, in UTC
+    def __init__(self, creation_times):
+        self.runs_df = pd.DataFrame({'sys/id': [f'RUN-{number}' for number in range(1, len(creation_times) + 1)],
+                                     'sys/creation_time': pd.to_datetime(creation_times)})
+
+    def fetch_runs_table(self, query=None, sort_by='sys/creation_time', ascending=False, limit=None):
+        runs_df = self.runs_df.sort_values('sys/creation_time', kind='stable')
+        if query is not None:
+            since = pd.Timestamp(re.search(r'>= "(.*)"', query).group(1)).tz_localize(None)
+            runs_df = runs_df.loc[runs_df['sys/creation_time'] >= since]
+        return FakeTable(runs_df.head(limit))
+
+
+class FakeProjectWithoutPaging(FakeProject):
+    # like clients of neptune < 1.9
+    def fetch_runs_table(self, id=None, state=None, owner=None, tag=None, columns=None):
+        return FakeTable(self.runs_df)
+
+
+def test_runs_table_pages_hold_every_run_once():
+    # every page is requested from the last creation time of the previous one, its runs are yielded only once
+    project = FakeProject(['2024-01-01 00:00', '2024-01-01 00:01', '2024-01-01 00:01', '2024-01-01 00:02',
+                           '2024-01-01 00:03', '2024-01-01 00:04', '2024-01-01 00:05'])
+    pages = list(iter_runs_table(project, 3, RequestScheduler()))
+    assert [run_id for page in pages for run_id in page['sys/id']] == [f'RUN-{number}' for number in range(1, 8)]
+    assert all(len(page) <= 3 for page in pages)
+
+
+def test_runs_table_page_size_must_exceed_runs_created_at_once():
+    project = FakeProject(['2024-01-01 00:00'] * 3)
+    with pytest.raises(RuntimeError):
+        list(iter_runs_table(project, 2, RequestScheduler()))
+
+
+def test_runs_table_without_paging():
+    project = FakeProjectWithoutPaging(['2024-01-01 00:00', '2024-01-01 00:01'])
+    assert [page['sys/id'].tolist() for page in iter_runs_table(project, 1, RequestScheduler())] == [['RUN-1', 'RUN-2']]
+
+
+def test_runs_table_errors_are_raised():
+    # a TypeError of a paging client is an error, not a reason to fetch the whole table
+    project = FakeProject(['2024-01-01 00:00'])
+    with mock.patch.object(FakeTable, 'to_pandas', side_effect=[TypeError('unexpected value'), project.runs_df]):
+        with pytest.raises(TypeError):
+            list(iter_runs_table(project, 1, RequestScheduler()))
+
+
+def test_parquet_series_round_trip(tmp_path):
+    pytest.importorskip('pyarrow')
+    backend = FakeBackend(ProjectShape(runs=2, series_length=25, file_size=16), latency=0)
+    with backend.patch():
+        assert Archiver(tmp_path, archive_name='archive', project_id='workspace/project',
+                        series_format=SeriesFormats.PARQUET).archive() == []
+        retriever = Retriever(tmp_path / 'archive', 'workspace', 'restored', series_chunk_size=10)
+        for run_id in backend.run_ids:
+            with retriever.storage.open(join_name(run_id, RUN_STRUCTURE)) as file:
+                run_structure = json.load(file)
+            for remote_key in (RemoteKeys.FLOAT_SERIES, RemoteKeys.STRING_SERIES):
+                for path, name in run_structure[remote_key.value].items():
+                    # all series of a type share one parquet file, read in chunks of series_chunk_size points
+                    series_df = pd.concat(retriever.read_series(join_name(run_id, name), path, na_filter=False))
+                    steps, values, timestamps = backend.series(run_id, path,
+                                                               strings=(remote_key == RemoteKeys.STRING_SERIES))
+                    assert series_df['step'].tolist() == steps.tolist()
+                    assert series_df['value'].tolist() == values.tolist()
+                    assert np.allclose(series_df['timestamp'] * 1000, timestamps)
+        assert retriever.restore() == []
+
+
+def test_parquet_requires_pyarrow_up_front(tmp_path):
+    backend = FakeBackend(ProjectShape(runs=2), latency=0)
+    with backend.patch(), mock.patch.dict(sys.modules, {'pyarrow': None}):
+        with pytest.raises(ImportError, match='--series-format parquet requires pyarrow'):
+            Archiver(tmp_path, archive_name='archive', project_id='workspace/project',
+                     series_format=SeriesFormats.PARQUET)
+    assert backend.requests == 0
+
+
+def list_files(directory):
+    return {path.relative_to(directory).as_posix(): path.stat().st_mtime_ns for path in directory.rglob('*')
+            if path.is_file()}
+
+
+def test_incremental_archiving(tmp_path):
+    backend = FakeBackend(ProjectShape(runs=3, series_length=10, file_size=16), latency=0)
+    fetch_file = NeptuneObjArchiver.fetch_file
+    archive_run = Archiver.archive_run
+    archived_runs = []
+
+    def fail_on_bench_3(obj_archiver, file):
+        if obj_archiver.prefix == 'BENCH-3':
+            raise RuntimeError('download failed')
+        return fetch_file(obj_archiver, file)
+
+    def record_run(archiver, run_id, *args):
+        archived_runs.append(run_id)
+        return archive_run(archiver, run_id, *args)
+
+    with backend.patch():
+        with mock.patch.object(NeptuneObjArchiver, 'fetch_file', fail_on_bench_3):
+            assert Archiver(tmp_path, archive_name='archive', project_id='workspace/project',
+                            incremental=True).archive() == ['BENCH-3']
+        archive_path = tmp_path / 'archive'
+        unchanged_files = list_files(archive_path / 'BENCH-1')
+        replaced_files = set(list_files(archive_path / 'BENCH-2')) - {RUN_STRUCTURE}
+        backend.modify_run('BENCH-2')
+        with mock.patch.object(Archiver, 'archive_run', record_run):
+            assert Archiver(tmp_path, archive_name='archive', project_id='workspace/project',
+                            incremental=True).archive() == []
+        # the unchanged run is skipped, the modified and the failed run are archived again
+        assert sorted(archived_runs) == ['BENCH-2', 'BENCH-3']
+        assert list_files(archive_path / 'BENCH-1') == unchanged_files
+        assert not replaced_files & set(list_files(archive_path / 'BENCH-2'))
+        # every run has one file, the blob of the replaced version of BENCH-2 is removed
+        assert len(list_files(archive_path / BLOBS_DIR)) == 3
+        verifier = Verifier(archive_path)
+        assert verifier.verify_checksums() == []
+        assert verifier.compare_with_project('workspace/project') == []
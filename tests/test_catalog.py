@@ -0,0 +1,66 @@
+import pytest
+from src.catalog import Catalog, parse_condition
+from src.storage import open_archive
+from src.utils import RemoteKeys
+
+
+def make_structure(atoms=None, tags=(), creation_time=0.0):
+    structure = {remote_key.value: {} for remote_key in RemoteKeys}
+    structure[RemoteKeys.ATOMS.value] = atoms or {}
+    structure[RemoteKeys.STRING_SETS.value] = {'sys/tags': list(tags)}
+    structure[RemoteKeys.TIME_STAMPS.value] = {'sys/creation_time': creation_time}
+    return structure
+
+
+@pytest.fixture
+def catalog(tmp_path):
+    storage = open_archive(tmp_path / 'archive', mode='w')
+    catalog = Catalog(storage.staging_path('catalog.sqlite'))
+    catalog.add_run('RUN-1', make_structure({'sys/name': 'baseline', 'params/flag': True, 'params/lr': 0.1},
+                                            tags=['a', 'b'], creation_time=1.0), storage,
+                    {'metrics/acc': (10, 9.0, 0.95), 'logs/stdout': (2, 1.0, 'done')})
+    catalog.add_run('RUN-2', make_structure({'sys/name': 'other', 'params/flag': False, 'params/lr': 0.01},
+                                            tags=['b'], creation_time=2.0), storage,
+                    {'metrics/acc': (10, 9.0, 0.5)})
+    yield catalog
+    catalog.close()
+
+
+def test_parse_condition():
+    assert parse_condition('val/acc > 0.9') == ('val/acc', '>', 0.9)
+    assert parse_condition('sys/name = "baseline"') == ('sys/name', '=', 'baseline')
+    assert parse_condition('params/flag == True') == ('params/flag', '==', 1.0)
+    assert parse_condition('params/flag != false') == ('params/flag', '!=', 0.0)
+    with pytest.raises(ValueError):
+        parse_condition('val/acc')
+
+
+def test_query_atoms_and_tags(catalog):
+    assert catalog.query(tags=['b']) == ['RUN-1', 'RUN-2']
+    assert catalog.query(tags=['a', 'b']) == ['RUN-1']
+    assert catalog.query(conditions=['sys/name = baseline']) == ['RUN-1']
+    assert catalog.query(conditions=['params/lr < 0.05']) == ['RUN-2']
+    # numbers do not compare with text
+    assert catalog.query(conditions=['sys/name > 0']) == []
+
+
+def test_query_booleans(catalog):
+    assert catalog.query(conditions=['params/flag = True']) == ['RUN-1']
+    assert catalog.query(conditions=['params/flag = false']) == ['RUN-2']
+
+
+def test_query_last_values_of_series(catalog):
+    assert catalog.query(conditions=['metrics/acc > 0.9']) == ['RUN-1']
+    assert catalog.query(conditions=['metrics/acc > 0']) == ['RUN-1', 'RUN-2']
+    assert catalog.query(conditions=['logs/stdout = done']) == ['RUN-1']
+    assert catalog.query(tags=['b'], conditions=['metrics/acc < 0.9', 'params/lr < 1']) == ['RUN-2']
+
+
+def test_add_catalog(tmp_path, catalog):
+    other = Catalog(tmp_path / 'other.sqlite')
+    other.add_catalog(tmp_path / 'archive' / 'catalog.sqlite')
+    assert [run[0] for run in other.list_runs()] == ['RUN-1', 'RUN-2']
+    assert other.get_series('RUN-1')['metrics/acc'] == (10, 9.0, 0.95)
+    other.add_catalog(tmp_path / 'archive' / 'catalog.sqlite')  # runs in both are replaced, not duplicated
+    assert other.query(tags=['b']) == ['RUN-1', 'RUN-2']
+    other.close()
@@ -0,0 +1,75 @@
+import json
+import pandas as pd
+import pytest
+import src.utils as utils
+from src.catalog import Catalog
+from src.merger import Merger
+from src.storage import hash_file, blob_name, join_name, open_archive
+from src.utils import RemoteKeys
+
+
+def write_archive(path, run_ids, project=True, failed_run_ids=(), runs_table_ids=None):
+    # archive with a shared blob per run, leftovers of failed runs and a runs table
+    storage = open_archive(path, mode='w')
+    catalog = Catalog(storage.staging_path(utils.CATALOG))
+    if project:
+        with storage.open(utils.PROJECT_STRUCTURE, mode='w') as file:
+            json.dump({RemoteKeys.ATOMS.value: {'sys/name': 'project'}}, file)
+    blob_path = path.parent / (path.name + '-blob')
+    for run_id in run_ids:
+        blob_path.write_bytes(b'shared content')
+        reference = hash_file(blob_path)
+        storage.add_blob(blob_name(reference), blob_path)
+        structure = {remote_key.value: {} for remote_key in RemoteKeys}
+        structure[RemoteKeys.FILES.value] = {'model': reference}
+        with storage.open(join_name(run_id, utils.RUN_STRUCTURE), mode='w') as file:
+            json.dump(structure, file)
+        catalog.add_run(run_id, structure, storage)
+    for run_id in failed_run_ids:
+        with storage.open(join_name(run_id, utils.PARQUET_SERIES_FILES[RemoteKeys.FLOAT_SERIES]), mode='wb') as file:
+            file.write(b'partial')
+    pd.DataFrame({'sys/id': runs_table_ids if runs_table_ids is not None else run_ids}).to_csv(
+        storage.staging_path(utils.RUNS_TABLE), index=False)
+    catalog.close()
+    storage.close()
+
+
+@pytest.mark.parametrize('destination_name', ['merged', 'merged.zip'])
+def test_merge_shards(tmp_path, destination_name):
+    write_archive(tmp_path / 'shard-0', ['RUN-1', 'RUN-3'])
+    write_archive(tmp_path / 'shard-1.zip', ['RUN-2'], project=False)
+    Merger([tmp_path / 'shard-0', tmp_path / 'shard-1.zip'], tmp_path / destination_name).merge()
+    storage = open_archive(tmp_path / destination_name)
+    assert storage.list_runs() == ['RUN-1', 'RUN-2', 'RUN-3']
+    assert storage.exists(utils.PROJECT_STRUCTURE)
+    assert len([name for name in storage.list_members() if name.startswith('blobs/')]) == 1
+    checksums = storage.read_checksums()
+    assert all(storage.hash_member(name) == digest for name, digest in checksums.items())
+    catalog = Catalog.open(storage)
+    assert sorted(run[0] for run in catalog.list_runs()) == ['RUN-1', 'RUN-2', 'RUN-3']
+    catalog.close()
+    storage.close()
+
+
+def test_merge_retried_failed_runs(tmp_path):
+    # the original archive holds leftovers of RUN-2 and, like the retry archive, the whole runs table
+    write_archive(tmp_path / 'original.zip', ['RUN-1'], failed_run_ids=['RUN-2'], runs_table_ids=['RUN-1', 'RUN-2'])
+    write_archive(tmp_path / 'retry.zip', ['RUN-2'], project=False, runs_table_ids=['RUN-1', 'RUN-2'])
+    Merger([tmp_path / 'original.zip', tmp_path / 'retry.zip'], tmp_path / 'merged').merge()
+    storage = open_archive(tmp_path / 'merged')
+    assert storage.list_runs() == ['RUN-1', 'RUN-2']
+    assert not storage.exists(join_name('RUN-2', utils.PARQUET_SERIES_FILES[RemoteKeys.FLOAT_SERIES]))
+    assert pd.read_csv(tmp_path / 'merged' / utils.RUNS_TABLE)['sys/id'].tolist() == ['RUN-1', 'RUN-2']
+
+
+def test_merge_rejects_overlapping_shards(tmp_path):
+    write_archive(tmp_path / 'shard-0', ['RUN-1'])
+    write_archive(tmp_path / 'shard-1', ['RUN-1'], project=False)
+    with pytest.raises(ValueError):
+        Merger([tmp_path / 'shard-0', tmp_path / 'shard-1'], tmp_path / 'merged').get_members()
+
+
+def test_merge_requires_project(tmp_path):
+    write_archive(tmp_path / 'shard-1', ['RUN-1'], project=False)
+    with pytest.raises(ValueError):
+        Merger([tmp_path / 'shard-1'], tmp_path / 'merged').get_members()
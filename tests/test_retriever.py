@@ -0,0 +1,81 @@
+from unittest import mock
+import pytest
+
+pytest.importorskip('neptune')
+
+from benchmarks.fake_neptune import FakeBackend, FakeFileSeries, ProjectShape  # noqa: E402
+from src.archiver import Archiver  # noqa: E402
+from src.retriever import AttributeFilter, Retriever  # noqa: E402
+from src.utils import RemoteKeys  # noqa: E402
+
+
+def make_structure():
+    structure = {remote_key.value: {} for remote_key in RemoteKeys}
+    structure[RemoteKeys.ATOMS.value] = {'sys/name': 'run', 'params/lr': 0.1}
+    structure[RemoteKeys.FLOAT_SERIES.value] = {'metrics/train/loss': 1, 'metrics/val/acc': 2}
+    structure[RemoteKeys.FILES.value] = {'model/weights': 'sha256:0'}
+    return structure
+
+
+def test_no_filter_keeps_structure():
+    structure = make_structure()
+    assert AttributeFilter().apply(structure) is structure
+
+
+def test_include_and_exclude_globs():
+    structure = AttributeFilter(include=['metrics/*', 'sys/*'], exclude=['*/val/*']).apply(make_structure())
+    assert structure[RemoteKeys.ATOMS.value] == {'sys/name': 'run'}
+    assert structure[RemoteKeys.FLOAT_SERIES.value] == {'metrics/train/loss': 1}  # * also matches /
+    assert structure[RemoteKeys.FILES.value] == {}
+
+
+def test_globs_are_case_sensitive():
+    assert AttributeFilter(include=['Metrics/*']).apply(make_structure())[RemoteKeys.FLOAT_SERIES.value] == {}
+
+
+def test_skipped_types():
+    structure = AttributeFilter(skipped_types=[RemoteKeys.FILES]).apply(make_structure())
+    assert structure[RemoteKeys.FILES.value] == {}
+    assert structure[RemoteKeys.ATOMS.value] == {'sys/name': 'run', 'params/lr': 0.1}
+
+
+def test_restore_empty_file_series(tmp_path):
+    # an empty file series is archived without files, a file series with files next to it is restored as usual
+    backend = FakeBackend(ProjectShape(runs=2, series_length=10, file_size=16, file_series_files=2), latency=0)
+    run_structure = backend.run_structure
+    backend.run_structure = lambda run_id: {**run_structure(run_id), 'empty_images': FakeFileSeries(backend, [])}
+    with backend.patch():
+        assert Archiver(tmp_path, archive_name='archive', project_id='workspace/project').archive() == []
+        assert Retriever(tmp_path / 'archive', 'workspace', 'restored').restore() == []
+    assert backend.bytes_uploaded >= 2 * (2 + 1) * 16  # file series and file of both runs
+
+
+def test_failed_restore_moves_run_to_trash(tmp_path, capsys):
+    backend = FakeBackend(ProjectShape(runs=2, series_length=10, file_size=16), latency=0)
+    with backend.patch():
+        assert Archiver(tmp_path, archive_name='archive', project_id='workspace/project').archive() == []
+        retriever = Retriever(tmp_path / 'archive', 'workspace', 'restored')
+        traverse_local_structure = retriever.traverse_local_structure
+
+        def fail_on_first_run(remote_structure, neptune_object, source, *args):
+            traverse_local_structure(remote_structure, neptune_object, source, *args)
+            if source == 'BENCH-1':
+                raise RuntimeError('upload failed')
+
+        with mock.patch.object(retriever, 'traverse_local_structure', fail_on_first_run):
+            assert retriever.restore(create_project=False, upload_project=False) == ['BENCH-1']
+    assert len(backend.created_ids) == 2 and len(backend.trashed_ids) == 1
+    assert 'Restoring run BENCH-1 failed: upload failed' in capsys.readouterr().out
+
+
+def test_failed_trashing_does_not_hide_the_error(tmp_path, capsys):
+    backend = FakeBackend(ProjectShape(runs=1, series_length=10, file_size=16), latency=0)
+    with backend.patch():
+        assert Archiver(tmp_path, archive_name='archive', project_id='workspace/project').archive() == []
+        retriever = Retriever(tmp_path / 'archive', 'workspace', 'restored')
+        with mock.patch.object(retriever, 'traverse_local_structure', side_effect=RuntimeError('upload failed')), \
+                mock.patch('neptune.management.trash_objects', side_effect=RuntimeError('trash unavailable')):
+            assert retriever.restore(create_project=False, upload_project=False) == ['BENCH-1']
+    output = capsys.readouterr().out
+    assert 'trash failed: trash unavailable. Delete it before restoring BENCH-1 again' in output
+    assert 'Restoring run BENCH-1 failed: upload failed' in output
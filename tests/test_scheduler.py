@@ -0,0 +1,82 @@
+import pytest
+
+pytest.importorskip('neptune')
+
+from neptune.exceptions import ClientHttpError, NeptuneConnectionLostException  # noqa: E402
+from src.scheduler import RequestScheduler, is_throttled, is_transient  # noqa: E402
+
+
+class Flaky:
+    # fails with the given exceptions, then returns 'done'
+    def __init__(self, *exceptions):
+        self.exceptions = list(exceptions)
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        if self.exceptions:
+            raise self.exceptions.pop(0)
+        return 'done'
+
+
+def test_is_transient():
+    assert is_transient(ClientHttpError(503, ''))
+    assert not is_transient(ClientHttpError(404, ''))
+    assert is_transient(ConnectionError())
+    assert not is_transient(ValueError())
+    assert is_throttled(NeptuneConnectionLostException(ClientHttpError(429, '')))
+
+
+def test_retries_transient_failures():
+    function = Flaky(ConnectionError(), TimeoutError())
+    assert RequestScheduler(retries=2, base_delay=0).call('structure', function) == 'done'
+    assert function.calls == 3
+
+
+def test_gives_up_after_retries():
+    function = Flaky(ConnectionError(), ConnectionError(), ConnectionError())
+    with pytest.raises(ConnectionError):
+        RequestScheduler(retries=2, base_delay=0).call('structure', function)
+    assert function.calls == 3
+
+
+def test_does_not_retry_other_failures():
+    function = Flaky(ValueError())
+    with pytest.raises(ValueError):
+        RequestScheduler(retries=2, base_delay=0).call('structure', function)
+    assert function.calls == 1
+
+
+def test_limit_is_halved_on_failures_and_grows_by_one():
+    scheduler = RequestScheduler(max_concurrency=8)
+    scheduler.acquire()
+    scheduler.release('structure', 0.1, transient_failure=True)
+    assert scheduler.limit == 4
+    scheduler.acquire()
+    scheduler.release('structure', 0.1, transient_failure=True)
+    assert scheduler.limit == 4  # failures of the same congestion only halve the limit once
+    for _ in range(4):
+        scheduler.acquire()
+        scheduler.release('structure', 0.1)
+    assert scheduler.limit == 5
+
+
+def test_limit_is_halved_when_requests_slow_down():
+    scheduler = RequestScheduler(max_concurrency=8)
+    for _ in range(8):
+        scheduler.acquire()
+        scheduler.release('structure', 0.1)
+    for _ in range(10):
+        scheduler.acquire()
+        scheduler.release('structure', 10.0)
+    assert scheduler.limit == 4
+    scheduler.acquire()
+    scheduler.release(None, 100.0)  # requests without a kind only count their outcome
+    assert scheduler.limit == 4
+
+
+def test_fixed_concurrency():
+    scheduler = RequestScheduler(max_concurrency=8, adaptive=False)
+    scheduler.acquire()
+    scheduler.release('structure', 0.1, transient_failure=True)
+    assert scheduler.limit == 8
@@ -0,0 +1,80 @@
+import json
+import pandas as pd
+import pytest
+from src.storage import COMPRESSED_SUFFIX, blob_name, hash_file, join_name, open_archive
+from src.utils import ARCHIVING_LOG, PROJECT_STRUCTURE, RUN_STRUCTURE, RemoteKeys
+
+
+def add_blob(storage, path, content):
+    path.write_bytes(content)
+    reference = hash_file(path)
+    storage.add_blob(blob_name(reference), path)
+    return reference
+
+
+def test_list_unreferenced_blobs(tmp_path):
+    storage = open_archive(tmp_path / 'archive', mode='w')
+    file_reference = add_blob(storage, tmp_path / 'file', b'file')
+    file_set_reference = add_blob(storage, tmp_path / 'file-set-member', b'file set member')
+    project_reference = add_blob(storage, tmp_path / 'project-file', b'project file')
+    unreferenced = add_blob(storage, tmp_path / 'replaced-file', b'file of a replaced version of the run')
+    structure = {remote_key.value: {} for remote_key in RemoteKeys}
+    structure[RemoteKeys.FILES.value] = {'model': file_reference}
+    structure[RemoteKeys.FILE_SETS.value] = {'source_code/files': {'train.py': file_set_reference}}
+    structure[RemoteKeys.ATOMS.value] = {'sys/description': unreferenced}  # an atom is not a reference
+    with storage.open(join_name('RUN-1', RUN_STRUCTURE), mode='w') as file:
+        json.dump(structure, file)
+    with storage.open(PROJECT_STRUCTURE, mode='w') as file:
+        json.dump({RemoteKeys.FILES.value: {'data': project_reference}}, file)
+    assert storage.list_unreferenced_blobs() == [blob_name(unreferenced)]
+    storage.remove(blob_name(unreferenced))
+    storage.close()
+    storage = open_archive(tmp_path / 'archive')
+    assert storage.list_unreferenced_blobs() == []
+    assert blob_name(unreferenced) not in storage.read_checksums()
+
+
+@pytest.mark.parametrize('archive_name', ['archive', 'archive.zip'])
+def test_compressed_members_round_trip(tmp_path, archive_name):
+    pytest.importorskip('zstandard')
+    storage = open_archive(tmp_path / archive_name, mode='w')
+    with storage.open(join_name('RUN-1', RUN_STRUCTURE + COMPRESSED_SUFFIX), mode='w') as file:
+        json.dump({RemoteKeys.ATOMS.value: {'sys/name': 'run'}}, file)
+    with storage.open(join_name('RUN-1', 'series.csv' + COMPRESSED_SUFFIX), mode='w') as file:
+        pd.DataFrame({'step': [0.0, 1.0], 'value': ['a', 'b'], 'timestamp': [1.0, 2.0]}).to_csv(file, index=False)
+    for line in ('first archiving\n', 'second archiving\n'):  # an incremental archiving adds a frame to the log
+        with storage.staging_path(ARCHIVING_LOG).open('w') as log_file:
+            log_file.write(line)
+        storage.compress_staged(ARCHIVING_LOG)
+    storage.close()
+    storage = open_archive(tmp_path / archive_name)
+    assert storage.resolve(join_name('RUN-1', RUN_STRUCTURE)) == join_name('RUN-1', RUN_STRUCTURE + COMPRESSED_SUFFIX)
+    with storage.open(join_name('RUN-1', RUN_STRUCTURE)) as file:
+        assert json.load(file) == {RemoteKeys.ATOMS.value: {'sys/name': 'run'}}
+    with storage.open(join_name('RUN-1', 'series.csv' + COMPRESSED_SUFFIX), mode='rb') as file:
+        assert pd.read_csv(file, na_filter=False)['value'].tolist() == ['a', 'b']
+    with storage.open(ARCHIVING_LOG) as file:
+        assert file.read() == 'first archiving\nsecond archiving\n'
+    assert not storage.exists(ARCHIVING_LOG)
+    checksums = storage.read_checksums()
+    assert join_name('RUN-1', RUN_STRUCTURE + COMPRESSED_SUFFIX) in checksums
+    assert all(storage.hash_member(name) == digest for name, digest in checksums.items())
+    storage.close()
+
+
+def test_writing_a_member_replaces_its_other_compression(tmp_path):
+    # e.g. an uncompressed archive continued with --incremental --compression zstd
+    pytest.importorskip('zstandard')
+    storage = open_archive(tmp_path / 'archive', mode='w')
+    old_reference = add_blob(storage, tmp_path / 'old-file', b'old project file')
+    with storage.open(PROJECT_STRUCTURE, mode='w') as file:
+        json.dump({RemoteKeys.FILES.value: {'data': old_reference}}, file)
+    storage.close()
+    storage = open_archive(tmp_path / 'archive', mode='w', exist_ok=True)
+    new_reference = add_blob(storage, tmp_path / 'new-file', b'new project file')
+    with storage.open(PROJECT_STRUCTURE + COMPRESSED_SUFFIX, mode='w') as file:
+        json.dump({RemoteKeys.FILES.value: {'data': new_reference}}, file)
+    assert storage.resolve(PROJECT_STRUCTURE) == PROJECT_STRUCTURE + COMPRESSED_SUFFIX
+    assert storage.list_unreferenced_blobs() == [blob_name(old_reference)]
+    storage.close()
+    assert PROJECT_STRUCTURE not in open_archive(tmp_path / 'archive').read_checksums()
@@ -0,0 +1,61 @@
+import os
+import time
+from datetime import datetime, timezone
+import pandas as pd
+import pytest
+import src.utils as utils
+
+
+@pytest.fixture(autouse=True)
+def local_time_zone():
+    # a time zone away from UTC, such that local and UTC interpretations differ
+    previous = os.environ.get('TZ')
+    os.environ['TZ'] = 'Europe/Berlin'
+    time.tzset()
+    yield
+    if previous is None:
+        del os.environ['TZ']
+    else:
+        os.environ['TZ'] = previous
+    time.tzset()
+
+
+def test_table_datetime_to_timestamp_takes_naive_values_as_utc():
+    expected = datetime(2024, 1, 1, 12, tzinfo=timezone.utc).timestamp()
+    assert utils.table_datetime_to_timestamp(pd.Timestamp('2024-01-01 12:00:00')) == expected
+    assert utils.table_datetime_to_timestamp(datetime(2024, 1, 1, 12)) == expected
+    assert utils.table_datetime_to_timestamp(pd.Timestamp('2024-01-01 13:00:00+01:00')) == expected
+
+
+def test_datetimes_to_timestamps_takes_naive_values_as_local_time():
+    # fetch_values returns datetime.fromtimestamp of the points' timestampMillis, which must round trip
+    timestamps = [1704110400.0, 1719835200.5]  # winter and summer time
+    datetimes = pd.Series(pd.to_datetime([datetime.fromtimestamp(timestamp) for timestamp in timestamps]))
+    assert utils.datetimes_to_timestamps(datetimes).tolist() == timestamps
+
+
+def test_datetimes_to_timestamps_keeps_time_zones():
+    datetimes = pd.Series(pd.to_datetime(['2024-01-01 12:00:00+00:00']))
+    assert utils.datetimes_to_timestamps(datetimes).tolist() == [datetime(2024, 1, 1, 12,
+                                                                          tzinfo=timezone.utc).timestamp()]
+
+
+def test_concat_csv_files_unites_columns_as_text(tmp_path):
+    (tmp_path / 'a.csv').write_text('sys/id,params/lr\nRUN-1,0.10\n')
+    (tmp_path / 'b.csv').write_text('sys/id,sys/tags\nRUN-2,"a,b"\n')
+    utils.concat_csv_files([tmp_path / 'a.csv', tmp_path / 'b.csv'], tmp_path / 'out.csv')
+    assert (tmp_path / 'out.csv').read_text() == 'sys/id,params/lr,sys/tags\nRUN-1,0.10,\nRUN-2,,"a,b"\n'
+
+
+def test_concat_csv_files_keeps_first_row_of_key(tmp_path):
+    (tmp_path / 'a.csv').write_text('sys/id,sys/name\nRUN-1,first\nRUN-2,first\n')
+    (tmp_path / 'b.csv').write_text('sys/id,sys/name\nRUN-2,second\nRUN-3,second\nRUN-3,third\n')
+    utils.concat_csv_files([tmp_path / 'a.csv', tmp_path / 'b.csv'], tmp_path / 'out.csv', key='sys/id')
+    assert pd.read_csv(tmp_path / 'out.csv').values.tolist() == [['RUN-1', 'first'], ['RUN-2', 'first'],
+                                                                 ['RUN-3', 'second']]
+
+
+def test_require_module():
+    utils.require_module('json', '--option')
+    with pytest.raises(ImportError, match='--option requires not_installed_module'):
+        utils.require_module('not_installed_module', '--option')
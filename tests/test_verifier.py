@@ -0,0 +1,103 @@
+import hashlib
+import json
+import re
+import struct
+import zipfile
+import pytest
+
+pytest.importorskip('neptune')
+
+from benchmarks.fake_neptune import FakeBackend, ProjectShape  # noqa: E402
+from src.archiver import Archiver  # noqa: E402
+from src.storage import BLOBS_DIR, join_name  # noqa: E402
+from src.utils import ContainerFormats, RUN_STRUCTURE, RemoteKeys  # noqa: E402
+from src.verifier import Verifier  # noqa: E402
+
+
+def archive(tmp_path, container=None, runs=2):
+    backend = FakeBackend(ProjectShape(runs=runs, series_length=10, file_size=64, file_set_files=2), latency=0)
+    with backend.patch():
+        archiver = Archiver(tmp_path, archive_name='archive', project_id='workspace/project', container=container)
+        assert archiver.archive() == []
+    return backend, archiver.destination
+
+
+def blob_path(archive_path):
+    return next(path for path in (archive_path / BLOBS_DIR).rglob('*') if path.is_file())
+
+
+def corrupt_zip_member(zip_path, name):
+    # flips a byte of a stored member in place, the zip stays readable
+    with zipfile.ZipFile(zip_path) as zip_file:
+        member_info = zip_file.getinfo(name)
+    with open(zip_path, 'r+b') as file:
+        file.seek(member_info.header_offset + 26)
+        name_length, extra_length = struct.unpack('<HH', file.read(4))
+        file.seek(member_info.header_offset + 30 + name_length + extra_length)
+        byte = file.read(1)
+        file.seek(-1, 1)
+        file.write(bytes([byte[0] ^ 0xFF]))
+
+
+@pytest.mark.parametrize('container', [None, ContainerFormats.ZIP])
+def test_intact_archive(tmp_path, container):
+    _, archive_path = archive(tmp_path, container)
+    assert Verifier(archive_path).verify_checksums() == []
+
+
+def test_corrupted_missing_and_unlisted_members(tmp_path):
+    _, archive_path = archive(tmp_path)
+    corrupted_blob = blob_path(archive_path)
+    corrupted_blob.write_bytes(b'corrupted' + corrupted_blob.read_bytes()[9:])
+    (archive_path / 'BENCH-2' / RUN_STRUCTURE).unlink()
+    (archive_path / 'BENCH-1' / 'stray.csv').write_text('step,value\n')
+    problems = Verifier(archive_path).verify_checksums()
+    assert f'{corrupted_blob.relative_to(archive_path).as_posix()} is corrupted, its checksum does not match' in \
+        problems
+    assert f'BENCH-2/{RUN_STRUCTURE} is missing' in problems
+    assert 'BENCH-1/stray.csv is not listed in checksums.sha256' in problems
+
+
+def test_corrupted_zip_member(tmp_path):
+    # stored members of zip archives are hashed from a memory map of the zip, without checking their crc
+    _, archive_path = archive(tmp_path, ContainerFormats.ZIP)
+    corrupt_zip_member(archive_path, join_name('BENCH-1', RUN_STRUCTURE))
+    assert Verifier(archive_path).verify_checksums() == \
+        [f'BENCH-1/{RUN_STRUCTURE} is corrupted, its checksum does not match']
+
+
+def test_compare_with_project(tmp_path):
+    backend, archive_path = archive(tmp_path)
+    with backend.patch():
+        assert Verifier(archive_path).compare_with_project('workspace/project', check_series_lengths=True) == []
+
+
+def test_compare_with_changed_project(tmp_path):
+    _, archive_path = archive(tmp_path)
+    with (archive_path / 'BENCH-1' / RUN_STRUCTURE).open() as file:
+        run_structure = json.load(file)
+    run_structure[RemoteKeys.ATOMS.value]['params/param_0'] = 100.0
+    with (archive_path / 'BENCH-1' / RUN_STRUCTURE).open('w') as file:
+        json.dump(run_structure, file)
+    backend = FakeBackend(ProjectShape(runs=3, series_length=11, file_size=65, file_set_files=2), latency=0)
+    with backend.patch():
+        problems = Verifier(archive_path).compare_with_project('workspace/project', check_series_lengths=True)
+    assert 'BENCH-3 is not archived' in problems
+    assert 'BENCH-1: params/param_0 is 100.0 in the archive, 0.0 in the project' in problems
+    assert 'BENCH-2: metrics/metric_0 has 10 points in the archive, 11 in the project' in problems
+    assert 'BENCH-2: data/part_0.bin has 64 bytes in the archive, 65 in the project' in problems
+
+
+def test_unreferenced_blob(tmp_path):
+    _, archive_path = archive(tmp_path)
+    with (archive_path / 'BENCH-1' / RUN_STRUCTURE).open() as file:
+        run_structure = json.load(file)
+    run_structure[RemoteKeys.FILES.value] = {}
+    with (archive_path / 'BENCH-1' / RUN_STRUCTURE).open('w') as file:
+        json.dump(run_structure, file)
+    checksums = (archive_path / 'checksums.sha256').read_text()
+    digest = hashlib.sha256((archive_path / 'BENCH-1' / RUN_STRUCTURE).read_bytes()).hexdigest()
+    checksums = re.sub(f'.*  BENCH-1/{RUN_STRUCTURE}', f'{digest}  BENCH-1/{RUN_STRUCTURE}', checksums)
+    (archive_path / 'checksums.sha256').write_text(checksums)
+    problems = Verifier(archive_path).verify_checksums()
+    assert len(problems) == 1 and problems[0].endswith('is not referenced by any structure')